@@ -11,6 +11,7 @@ import asyncio
 import shutil
 from pathlib import Path
 from telegram_client import SafeTelegramClient
+from dialog_cache import get_dialog_cache
 from telethon import TelegramClient
 
 
@@ -190,7 +191,7 @@ class SummaryBot:
                     )
                     # Сохраняем клиент в app_instance
                     if self.app_instance:
-                        self.app_instance.telegram_clients[user.id] = client
+                        await self.app_instance.client_pool.put(user.id, client)
                     return
             
             # Предлагаем варианты авторизации
@@ -423,7 +424,7 @@ class SummaryBot:
                     if self.app_instance:
                         safe_client = SafeTelegramClient(user.id, user.phone)
                         if await safe_client.connect():
-                            self.app_instance.telegram_clients[user.id] = safe_client
+                            await self.app_instance.client_pool.put(user.id, safe_client)
                     
                     await update.message.reply_text(
                         "✅ Авторизация успешна!\n\n"
@@ -564,7 +565,7 @@ class SummaryBot:
             # Получаем список чатов пользователя через Client API
             if self.app_instance:
                 # Используем клиент из главного приложения
-                client = self.app_instance.telegram_clients.get(user.id)
+                client = self.app_instance.client_pool.get_existing(user.id)
                 if not client:
                     # Проверяем, есть ли сессия
                     session_file = settings.session_dir / f"user_{user.id}.session"
@@ -574,23 +575,21 @@ class SummaryBot:
                             "Используйте команду /auth для авторизации через номер телефона."
                         )
                         return
-                    
-                    # Создаем клиент если его нет
-                    client = SafeTelegramClient(user.id, user.phone)
-                    if await client.connect():
-                        self.app_instance.telegram_clients[user.id] = client
-                    else:
-                        await update.message.reply_text(
-                            "❌ Не удалось подключиться к Telegram Client API.\n\n"
-                            "Возможные причины:\n"
-                            "• Сессия устарела\n"
-                            "• Нужна повторная авторизация\n\n"
-                            "Используйте /auth для повторной авторизации."
-                        )
-                        return
                 
-                # Получаем список диалогов
-                dialogs = await client.get_user_dialogs()
+                # Получаем клиент из пула (подключается или переподключается при необходимости)
+                client = await self.app_instance.client_pool.get(user.id, user.phone)
+                if not client:
+                    await update.message.reply_text(
+                        "❌ Не удалось подключиться к Telegram Client API.\n\n"
+                        "Возможные причины:\n"
+                        "• Сессия устарела\n"
+                        "• Нужна повторная авторизация\n\n"
+                        "Используйте /auth для повторной авторизации."
+                    )
+                    return
+                
+                # Получаем список диалогов (из кэша, устаревший снимок обновляется в фоне)
+                dialogs = await get_dialog_cache().get(user.id, client)
                 
                 if not dialogs:
                     await update.message.reply_text("📭 Чаты не найдены.")
@@ -694,22 +693,17 @@ class SummaryBot:
                 
                 if action == 'on':
                     if not channel:
-                        # Получаем название чата
-                        chat_title = "Unknown"
+                        # Получаем название чата из снимка диалогов, показанного в /chats
+                        client = None
                         if self.app_instance:
-                            client = self.app_instance.telegram_clients.get(user.id)
-                            if client:
-                                dialogs = await client.get_user_dialogs()
-                                for d in dialogs:
-                                    if d['id'] == chat_id:
-                                        chat_title = d['title']
-                                        break
+                            client = self.app_instance.client_pool.get_existing(user.id)
+                        dialog = await get_dialog_cache().find_dialog(user.id, chat_id, client)
                         
                         channel = Channel(
                             user_id=user.id,
                             telegram_chat_id=chat_id,
-                            title=chat_title,
-                            chat_type='unknown',
+                            title=dialog['title'] if dialog else "Unknown",
+                            chat_type=dialog['type'] if dialog else 'unknown',
                             is_active=True
                         )
                         db.add(channel)
@@ -828,16 +822,18 @@ class SummaryBot:
         
         await update.message.reply_text(status_text)
     
-    async def send_summary(self, user_telegram_id: int, summary_text: str):
-        """Отправить сводку пользователю"""
+    async def send_summary(self, user_telegram_id: int, summary_text: str) -> bool:
+        """Отправить сводку пользователю; False - отправить не удалось"""
         try:
             await self.app.bot.send_message(
                 chat_id=user_telegram_id,
                 text=f"📊 Ваша ежедневная сводка:\n\n{summary_text}"
             )
             logger.info(f"Сводка отправлена пользователю {user_telegram_id}")
+            return True
         except Exception as e:
             logger.error(f"Ошибка отправки сводки: {e}")
+            return False
     
     async def import_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Импорт сессии из Telegram Desktop"""
@@ -949,7 +945,7 @@ class SummaryBot:
                                     if self.app_instance:
                                         safe_client = SafeTelegramClient(user.id, user.phone)
                                         if await safe_client.connect():
-                                            self.app_instance.telegram_clients[user.id] = safe_client
+                                            await self.app_instance.client_pool.put(user.id, safe_client)
                                     
                                     session_found = True
                                     logger.info(f"Сессия импортирована для пользователя {user_id} из {session_path}")
@@ -989,23 +985,36 @@ class SummaryBot:
         finally:
             db.close()
     
-    def run(self):
-        """Запуск бота (синхронная версия)"""
+    async def start(self):
+        """Запуск бота в текущем event loop (polling работает задачей этого же loop)"""
         logger.info("Запуск Telegram бота...")
-        self.app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
-    
-    async def run_async(self):
-        """Запуск бота (асинхронная версия)"""
-        logger.info("Запуск Telegram бота (async)...")
         await self.app.initialize()
         await self.app.start()
         await self.app.updater.start_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    
+    async def stop(self):
+        """Остановка бота"""
+        logger.info("Остановка бота...")
+        if self.app.updater and self.app.updater.running:
+            await self.app.updater.stop()
+        if self.app.running:
+            await self.app.stop()
+        await self.app.shutdown()
+        
+        # Временные клиенты незавершенных авторизаций
+        for client in list(self.auth_clients.values()):
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+        self.auth_clients.clear()
+    
+    async def run_async(self):
+        """Запуск бота (асинхронная версия)"""
+        await self.start()
         
         # Ждем бесконечно (бот работает)
         try:
             await asyncio.Event().wait()
-        except asyncio.CancelledError:
-            logger.info("Остановка бота...")
-            await self.app.updater.stop()
-            await self.app.stop()
-            await self.app.shutdown()
+        finally:
+            await self.stop()
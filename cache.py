@@ -0,0 +1,121 @@
+"""
+Кэши в памяти процесса
+"""
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, Optional
+
+
+@dataclass
+class CacheStats:
+    """Счетчики работы кэша"""
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0  # Вытеснено по LRU (лимит записей или байт)
+    expirations: int = 0  # Удалено по истечении TTL
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"попаданий: {self.hits}, промахов: {self.misses} ({self.hit_rate:.0%}), "
+            f"вытеснено: {self.evictions}, истекло: {self.expirations}"
+        )
+
+
+def _default_size(key: Hashable, value: Any) -> int:
+    """Примерный размер записи в байтах"""
+    def size(obj: Any) -> int:
+        if isinstance(obj, str):
+            return len(obj.encode("utf-8"))
+        if isinstance(obj, bytes):
+            return len(obj)
+        return sys.getsizeof(obj)
+    return size(key) + size(value)
+
+
+class TTLCache:
+    """
+    LRU-кэш с ограничением количества записей и временем жизни записи
+
+    max_bytes дополнительно ограничивает суммарный размер записей (по size_of);
+    при превышении любого лимита вытесняются давно не использованные записи.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        max_bytes: Optional[int] = None,
+        size_of: Callable[[Hashable, Any], int] = _default_size
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.stats = CacheStats()
+        self.total_bytes = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value, size)
+
+    def _remove(self, key: Hashable) -> tuple:
+        item = self._data.pop(key)
+        self.total_bytes -= item[2]
+        return item
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.stats.misses += 1
+            return default
+
+        expires_at, value, _ = item
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        size = self.size_of(key, value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Запись больше всего кэша не сохраняется
+            self.pop(key)
+            return
+
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + ttl, value, size)
+        self.total_bytes += size
+
+        while len(self._data) > self.max_entries or (
+            self.max_bytes is not None and self.total_bytes > self.max_bytes
+        ):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.stats.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._data:
+            return default
+        return self._remove(key)[1]
+
+    def clear(self):
+        self._data.clear()
+        self.total_bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,174 @@
+"""
+Пул подключенных клиентов Telegram Client API
+Ограничивает число одновременных подключений и отключает простаивающие клиенты
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from loguru import logger
+from config import settings
+from telegram_client import SafeTelegramClient
+
+
+@dataclass
+class PooledClient:
+    """Клиент в пуле и его состояние"""
+    client: SafeTelegramClient
+    last_used: float = field(default_factory=time.monotonic)
+    in_use: int = 0  # Сколько операций сейчас используют клиент
+
+
+class ClientPool:
+    """
+    Пул клиентов с вытеснением по LRU
+
+    - не больше max_clients подключений одновременно
+    - клиенты, простаивающие дольше idle_timeout, отключаются
+    - подключение создается лениво при первом обращении
+    - перед выдачей клиента проверяется соединение, при обрыве - переподключение
+    """
+
+    def __init__(self, max_clients: Optional[int] = None, idle_timeout: Optional[float] = None):
+        self.max_clients = max_clients or settings.max_telegram_clients
+        self.idle_timeout = idle_timeout or settings.client_idle_timeout_seconds
+        self._clients: "OrderedDict[int, PooledClient]" = OrderedDict()
+        self._connect_locks: Dict[int, asyncio.Lock] = {}
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._clients
+
+    def values(self):
+        return [entry.client for entry in self._clients.values()]
+
+    def get_existing(self, user_id: int) -> Optional[SafeTelegramClient]:
+        """Уже подключенный клиент пользователя без создания нового подключения"""
+        entry = self._clients.get(user_id)
+        if entry is None:
+            return None
+        entry.last_used = time.monotonic()
+        self._clients.move_to_end(user_id)
+        return entry.client
+
+    async def put(self, user_id: int, client: SafeTelegramClient):
+        """Добавить уже подключенный клиент (например, после авторизации)"""
+        old = self._clients.get(user_id)
+        if old is not None and old.client is not client:
+            await self._disconnect(user_id, old.client)
+
+        await self._insert(user_id, client)
+
+    async def _insert(self, user_id: int, client: SafeTelegramClient, in_use: int = 0):
+        self._clients[user_id] = PooledClient(client=client, in_use=in_use)
+        self._clients.move_to_end(user_id)
+        # Только что добавленный клиент не вытесняется, даже если остальные заняты
+        await self._evict_overflow(keep=user_id)
+
+    async def get(self, user_id: int, phone: Optional[str]) -> Optional[SafeTelegramClient]:
+        """Получить рабочий клиент пользователя, подключив его при необходимости"""
+        return await self._acquire(user_id, phone, hold=False)
+
+    async def _acquire(self, user_id: int, phone: Optional[str], hold: bool) -> Optional[SafeTelegramClient]:
+        """
+        Общая часть get() и checkout(): при hold клиент помечается занятым
+        до любого вытеснения, чтобы его не отключили между выдачей и использованием
+        """
+        lock = self._connect_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            entry = self._clients.get(user_id)
+            if entry is not None:
+                if await entry.client.is_healthy():
+                    entry.last_used = time.monotonic()
+                    entry.in_use += hold
+                    self._clients.move_to_end(user_id)
+                    return entry.client
+
+                logger.warning(f"Соединение пользователя {user_id} потеряно, переподключение")
+                await entry.client.disconnect()
+                if await entry.client.connect(phone):
+                    entry.last_used = time.monotonic()
+                    entry.in_use += hold
+                    self._clients.move_to_end(user_id)
+                    return entry.client
+
+                self._clients.pop(user_id, None)
+                return None
+
+            if not phone:
+                logger.error(f"У пользователя {user_id} не указан телефон")
+                return None
+
+            client = SafeTelegramClient(user_id, phone)
+            if not await client.connect():
+                logger.error(f"Не удалось подключиться для пользователя {user_id}")
+                return None
+
+            await self._insert(user_id, client, in_use=int(hold))
+            return client
+
+    async def checkout(self, user_id: int, phone: Optional[str]) -> Optional[SafeTelegramClient]:
+        """Получить клиент и защитить его от вытеснения до release()"""
+        return await self._acquire(user_id, phone, hold=True)
+
+    def release(self, user_id: int):
+        """Вернуть клиент, полученный через checkout()"""
+        entry = self._clients.get(user_id)
+        if entry is not None and entry.in_use > 0:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+
+    async def _disconnect(self, user_id: int, client: SafeTelegramClient):
+        try:
+            await client.disconnect()
+        except Exception as e:
+            logger.warning(f"Ошибка отключения клиента пользователя {user_id}: {e}")
+
+    async def _evict_overflow(self, keep: Optional[int] = None):
+        """Отключить давно не использовавшиеся клиенты сверх max_clients, кроме keep"""
+        if len(self._clients) <= self.max_clients:
+            return
+
+        for user_id in list(self._clients.keys()):
+            if len(self._clients) <= self.max_clients:
+                break
+            entry = self._clients[user_id]
+            if entry.in_use or user_id == keep:
+                continue
+            self._clients.pop(user_id)
+            await self._disconnect(user_id, entry.client)
+            logger.debug(f"Клиент пользователя {user_id} вытеснен из пула")
+
+        if len(self._clients) > self.max_clients:
+            logger.warning(
+                f"Все {len(self._clients)} клиентов пула заняты, лимит {self.max_clients} временно превышен"
+            )
+
+    async def evict_idle(self):
+        """Отключить клиенты, простаивающие дольше idle_timeout"""
+        now = time.monotonic()
+        for user_id, entry in list(self._clients.items()):
+            if entry.in_use or now - entry.last_used < self.idle_timeout:
+                continue
+            self._clients.pop(user_id, None)
+            await self._disconnect(user_id, entry.client)
+            logger.debug(f"Клиент пользователя {user_id} отключен по простою")
+
+    async def run_maintenance(self, interval: Optional[float] = None):
+        """Периодическое отключение простаивающих клиентов"""
+        interval = interval or max(self.idle_timeout / 4, 30)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания пула клиентов: {e}")
+
+    async def close_all(self):
+        """Отключить все клиенты"""
+        for user_id, entry in list(self._clients.items()):
+            await self._disconnect(user_id, entry.client)
+        self._clients.clear()
@@ -24,26 +24,93 @@ class Settings(BaseSettings):
     # AI/ML
     openai_api_key: Optional[str] = None
     openai_model: str = "gpt-4-turbo-preview"
+    openai_max_concurrency: int = 16  # Одновременных запросов к OpenAI (и соединений в пуле)
+    openai_timeout_seconds: float = 60.0  # Таймаут одного запроса
+    openai_max_retries: int = 5  # Попыток при 429, 5xx и таймаутах
+    openai_backoff_base_seconds: float = 1.0  # Первая задержка повтора, далее удваивается
     local_model_path: Optional[str] = None
     
     # Масштабирование и производительность
-    max_workers: int = 4  # Количество параллельных потоков для обработки
+    max_workers: int = 4  # Чатов, суммаризируемых одновременно (и потоков простой суммаризации)
     enable_caching: bool = True  # Включить кэширование результатов
     cache_ttl_seconds: int = 3600  # Время жизни кэша (1 час)
+    summary_cache_max_entries: int = 10000  # Максимум сводок в кэше
+    summary_cache_max_bytes: int = 64 * 1024 * 1024  # Максимальный объем кэша сводок (байт)
     batch_size: int = 4  # Размер батча для обработки
+    local_batch_wait_ms: float = 50.0  # Сколько ждать запросы для батча локальной модели
+    local_num_beams: int = 4  # Ширина beam search локальной модели
+    inference_workers: int = 0  # Процессов инференса локальной модели (0 - модель в процессе бота)
+    inference_worker_addresses: Optional[str] = None  # Внешние процессы "host:port,host:port"
+    inference_worker_host: str = "127.0.0.1"
+    inference_worker_base_port: int = 8765  # Порты запускаемых процессов: base, base+1, ...
+    inference_worker_threads: Optional[int] = None  # Потоков torch на процесс (по умолчанию ядра / процессы)
+    inference_timeout_seconds: float = 300.0  # Таймаут одного запроса к процессу инференса
+    inference_connect_timeout_seconds: float = 120.0  # Ожидание первого запуска процесса (загрузка модели)
+    inference_backoff_seconds: float = 10.0  # Недоступный процесс пропускается и перезапускается не чаще
     use_mps: bool = True  # Использовать Metal Performance Shaders на Mac
     
+    # Иерархическая суммаризация длинных вводов (map-reduce)
+    summary_hierarchical: bool = True  # False - только первые 50 сообщений, как раньше
+    summary_chunk_tokens: int = 1000  # Размер куска в токенах (вход локальной модели - до 1024)
+    summary_reduce_fanout: int = 8  # Сколько частичных сводок объединяется за один вызов
+    summary_max_depth: int = 3  # С этого уровня группа сводок ограничена только summary_chunk_tokens
+    summary_concurrency: int = 8  # Одновременных вызовов модели на одну сводку
+    
+    # Параллельное сканирование пользователей
+    scan_global_concurrency: int = 16  # Максимум одновременных сканирований
+    scan_per_account_concurrency: int = 1  # Максимум одновременных сканирований одного аккаунта
+    max_telegram_clients: int = 100  # Максимум одновременно подключенных клиентов Client API
+    client_idle_timeout_seconds: int = 900  # Отключать клиент после простоя (секунды)
+    dialog_cache_ttl_seconds: int = 300  # Снимок диалогов старше этого обновляется в фоне
+    dialog_cache_max_age_seconds: int = 86400  # Снимок диалогов удаляется из кэша
+    dialog_cache_max_users: int = 1000  # Максимум снимков диалогов в кэше
+    
+    # Шардирование сканирования между процессами (python main.py --scan-worker)
+    scan_sharding_enabled: bool = False
+    scan_worker_id: Optional[str] = None  # По умолчанию hostname-pid
+    scan_lease_ttl_seconds: int = 300  # Аренда пользователя без продления истекает
+    scan_lease_rescan_hours: int = 12  # Пользователь не сканируется повторно раньше этого
+    
+    # Конвейер этапов на надежной очереди (Redis при redis_url, иначе SQLite)
+    job_pipeline_enabled: bool = False
+    job_fetch_workers: int = 8  # Воркеры загрузки сообщений
+    job_summarize_workers: int = 4  # Воркеры суммаризации
+    job_deliver_workers: int = 2  # Воркеры доставки сводок
+    job_max_attempts: int = 5  # Попыток на задачу до пометки failed
+    job_retry_base_seconds: float = 30.0  # Первая задержка повтора, далее удваивается
+    job_visibility_timeout_seconds: int = 1800  # Задача без подтверждения возвращается в очередь
+    job_poll_interval_seconds: float = 1.0  # Пауза воркера при пустой очереди
+    
     # Настройки сканирования (безопасные по умолчанию)
     scan_base_hour: int = 22
     scan_base_minute: int = 0
     scan_time_variation_minutes: int = 30  # ±30 минут
+    scan_window_minutes: int = 240  # Окно, по которому распределяются слоты пользователей
+    scan_slot_jitter_minutes: int = 10  # Случайный сдвиг слота пользователя (±N минут)
+    scan_fleet_max_concurrency: int = 16  # Общий лимит одновременных сканирований (0 - без лимита)
+    scan_catchup_spread_minutes: int = 30  # Пропущенные за время простоя сканирования разносятся на N минут
+    schedule_sync_minutes: int = 10  # Период сверки расписания со списком пользователей
     max_chats_per_scan: int = 50
+    scan_page_size: int = 100  # Сообщений за один запрос (максимум API - 100)
+    scan_message_budget_per_chat: int = 1000  # Максимум сообщений из одного чата за сканирование
+    summary_lookback_hours: int = 24  # Сообщения старше последней сводки на столько часов не попадают в новую
+    sender_cache_size: int = 5000  # Авторов в кэше на один аккаунт
+    sender_cache_ttl_seconds: int = 86400  # Время жизни имени автора в кэше
     scan_delay_min_seconds: float = 1.0
     scan_delay_max_seconds: float = 5.0
     
+    # Live-режим: новые сообщения приходят через обновления Telegram
+    live_ingest_enabled: bool = False
+    live_flush_interval_seconds: float = 30.0  # Период записи буфера в БД
+    live_flush_batch_size: int = 500  # Запись буфера при накоплении сообщений
+    
     # Безопасность
     skip_scan_probability: float = 0.05  # 5% вероятность пропустить
-    max_requests_per_second: int = 20  # Запас от лимита
+    max_requests_per_second: int = 20  # Запас от лимита (на один аккаунт)
+    global_max_requests_per_second: int = 100  # Лимит запросов на весь процесс
+    rate_limit_burst: int = 5  # Допустимая пачка запросов одного аккаунта
+    flood_wait_max_retries: int = 3  # Повторы запроса после FLOOD_WAIT
+    flood_wait_max_seconds: int = 900  # Дольше этого не ждем, запрос пропускается
     
     # Логирование
     log_level: str = "INFO"
@@ -1,10 +1,11 @@
 """
 Модели базы данных для хранения сообщений и метаданных
 """
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Float, Boolean, ForeignKey, JSON
+from sqlalchemy import create_engine, inspect, insert, update, or_, text, Column, Integer, String, DateTime, Text, Float, Boolean, ForeignKey, JSON, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
+from typing import Dict, List, Optional
 from config import settings
 
 Base = declarative_base()
@@ -43,6 +44,7 @@ class Channel(Base):
     priority = Column(Integer, default=1)  # 1-высокий, 2-средний, 3-низкий
     is_active = Column(Boolean, default=True)
     last_scan_time = Column(DateTime, nullable=True)  # Время последнего сканирования
+    last_message_id = Column(Integer, nullable=True)  # ID последнего сохраненного сообщения (watermark)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Связи
@@ -66,6 +68,11 @@ class Message(Base):
     
     # Связи
     channel = relationship("Channel", back_populates="messages")
+    
+    __table_args__ = (
+        # Одно сообщение Telegram хранится в канале только один раз
+        Index("uq_messages_channel_message", "channel_id", "telegram_message_id", unique=True),
+    )
 
 
 class Summary(Base):
@@ -78,6 +85,8 @@ class Summary(Base):
     summary_text = Column(Text, nullable=False)
     topics = Column(JSON, default=[])  # Список тем
     channels_included = Column(JSON, default=[])  # ID каналов в сводке
+    run_id = Column(Integer, ForeignKey("scan_runs.id"), nullable=True, index=True)  # Запуск сканирования
+    delivered_at = Column(DateTime, nullable=True)  # Время отправки пользователю
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Связи
@@ -97,6 +106,91 @@ class UserInterest(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+class ScanRun(Base):
+    """Запуск сканирования пользователя по расписанию"""
+    __tablename__ = "scan_runs"
+    
+    id = Column(Integer, primary_key=True)
+    worker_id = Column(String, nullable=True, index=True)  # Процесс-сканер, выполняющий запуск
+    status = Column(String, default="running", index=True)  # 'running', 'done'
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class ScanCheckpoint(Base):
+    """Прогресс запуска сканирования по пользователю (telegram_chat_id = NULL) или по чату"""
+    __tablename__ = "scan_checkpoints"
+    
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("scan_runs.id"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    telegram_chat_id = Column(Integer, nullable=True)
+    status = Column(String, default="in_progress")  # 'in_progress', 'done'
+    last_message_id = Column(Integer, nullable=True)  # Достигнутый watermark чата
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_scan_checkpoints_run_user", "run_id", "user_id"),
+    )
+
+
+class ScanLease(Base):
+    """Аренда пользователя процессом-сканером (шардирование сканирования)"""
+    __tablename__ = "scan_leases"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    worker_id = Column(String, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)  # После истечения пользователь свободен
+    last_completed_at = Column(DateTime, nullable=True)  # Последнее завершенное сканирование
+    live_worker_id = Column(String, nullable=True)  # Процесс, держащий live-подписку пользователя
+    live_expires_at = Column(DateTime, nullable=True)
+
+
+class ScheduleEntry(Base):
+    """Время следующего запуска задачи планировщика (сканирование пользователя и т.п.)"""
+    __tablename__ = "schedule_entries"
+    
+    key = Column(String, primary_key=True)  # Например, 'scan:42'
+    next_run_at = Column(DateTime, nullable=False)  # UTC
+    last_run_at = Column(DateTime, nullable=True)  # UTC
+
+
+def _migrate_schema(engine):
+    """
+    Добавить в существующие таблицы недостающие nullable-колонки
+    create_all создает только новые таблицы, но не меняет существующие
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                ))
+    
+    # Уникальный индекс сообщений: перед созданием убираем накопившиеся дубликаты
+    if "messages" in existing_tables:
+        existing_indexes = {i['name'] for i in inspector.get_indexes("messages")}
+        if "uq_messages_channel_message" not in existing_indexes:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "DELETE FROM messages WHERE id NOT IN ("
+                    "SELECT MIN(id) FROM messages GROUP BY channel_id, telegram_message_id)"
+                ))
+                for index in Message.__table__.indexes:
+                    if index.name == "uq_messages_channel_message":
+                        index.create(conn)
+
+
 # Создаем движок БД
 try:
     engine = create_engine(
@@ -107,6 +201,7 @@ try:
     
     # Создаем таблицы (только если подключение успешно)
     try:
+        _migrate_schema(engine)
         Base.metadata.create_all(engine)
     except Exception as e:
         # Если не удалось подключиться, не падаем при импорте
@@ -120,6 +215,155 @@ except Exception as e:
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+def bulk_insert_messages(db, rows: List[Dict]) -> int:
+    """
+    Вставить пачку сообщений одним запросом, пропуская уже сохраненные
+    Дубликаты определяются уникальным индексом (channel_id, telegram_message_id)
+    Возвращает количество новых строк
+    """
+    if not rows:
+        return 0
+    
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        
+        stmt = dialect_insert(Message.__table__).values(rows).on_conflict_do_nothing(
+            index_elements=["channel_id", "telegram_message_id"]
+        )
+        return db.execute(stmt).rowcount
+    
+    # Прочие СУБД: отбрасываем уже сохраненные сообщения и вставляем через executemany
+    channel_ids = {row["channel_id"] for row in rows}
+    existing = set(
+        db.query(Message.channel_id, Message.telegram_message_id).filter(
+            Message.channel_id.in_(channel_ids),
+            Message.telegram_message_id.in_({row["telegram_message_id"] for row in rows})
+        ).all()
+    )
+    new_rows = []
+    seen = set(existing)
+    for row in rows:
+        key = (row["channel_id"], row["telegram_message_id"])
+        if key not in seen:
+            seen.add(key)
+            new_rows.append(row)
+    
+    if new_rows:
+        db.execute(insert(Message.__table__), new_rows)
+    return len(new_rows)
+
+
+def advance_watermarks(db, watermarks: Dict[int, int]):
+    """
+    Сдвинуть watermark каналов (channel_id -> message_id) только вперед
+    Безопасно при одновременной записи из сканирования и live-режима
+    """
+    for channel_id, message_id in watermarks.items():
+        db.execute(
+            update(Channel)
+            .where(
+                Channel.id == channel_id,
+                or_(Channel.last_message_id.is_(None), Channel.last_message_id < message_id)
+            )
+            .values(last_message_id=message_id)
+        )
+
+
+def save_scan_checkpoint(
+    db,
+    run_id: int,
+    user_id: int,
+    telegram_chat_id: Optional[int] = None,
+    status: str = "in_progress",
+    last_message_id: Optional[int] = None
+):
+    """
+    Записать прогресс сканирования (без commit - вызывающий коммитит вместе с данными)
+    telegram_chat_id = None - отметка по пользователю целиком
+    """
+    values = {"status": status, "updated_at": datetime.utcnow()}
+    if last_message_id is not None:
+        values["last_message_id"] = last_message_id
+    
+    chat_filter = (
+        ScanCheckpoint.telegram_chat_id.is_(None)
+        if telegram_chat_id is None
+        else ScanCheckpoint.telegram_chat_id == telegram_chat_id
+    )
+    result = db.execute(
+        update(ScanCheckpoint)
+        .where(ScanCheckpoint.run_id == run_id, ScanCheckpoint.user_id == user_id, chat_filter)
+        .values(**values)
+    )
+    if result.rowcount == 0:
+        db.execute(insert(ScanCheckpoint).values(
+            run_id=run_id,
+            user_id=user_id,
+            telegram_chat_id=telegram_chat_id,
+            **values
+        ))
+
+
+def load_schedule(db, keys: List[str]) -> Dict[str, datetime]:
+    """Сохраненное время следующего запуска задач (UTC) одним запросом"""
+    result: Dict[str, datetime] = {}
+    # Порциями, чтобы не упереться в лимит параметров запроса
+    for start in range(0, len(keys), 500):
+        rows = db.query(ScheduleEntry.key, ScheduleEntry.next_run_at).filter(
+            ScheduleEntry.key.in_(keys[start:start + 500])
+        ).all()
+        result.update(rows)
+    return result
+
+
+def save_schedule(db, next_runs: Dict[str, datetime], last_run_at: Optional[datetime] = None):
+    """
+    Записать время следующего запуска задач (UTC, без commit)
+    Одним upsert-запросом: одновременная запись того же ключа другим процессом не падает
+    на уникальности; last_run_at меняется, только если передан
+    """
+    if not next_runs:
+        return
+    
+    rows = [
+        {"key": key, "next_run_at": next_run_at, "last_run_at": last_run_at}
+        for key, next_run_at in next_runs.items()
+    ]
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        
+        stmt = dialect_insert(ScheduleEntry.__table__).values(rows)
+        values = {"next_run_at": stmt.excluded.next_run_at}
+        if last_run_at is not None:
+            values["last_run_at"] = stmt.excluded.last_run_at
+        db.execute(stmt.on_conflict_do_update(index_elements=["key"], set_=values))
+        return
+    
+    # Прочие СУБД: существующие строки обновляются, новые добавляются пачкой
+    existing = set(load_schedule(db, list(next_runs)))
+    
+    updates = []
+    for key in existing:
+        values = {"key": key, "next_run_at": next_runs[key]}
+        if last_run_at is not None:
+            values["last_run_at"] = last_run_at
+        updates.append(values)
+    if updates:
+        db.bulk_update_mappings(ScheduleEntry, updates)
+    
+    new_rows = [row for row in rows if row["key"] not in existing]
+    if new_rows:
+        db.execute(insert(ScheduleEntry.__table__), new_rows)
+
+
 def get_db():
     """Получить сессию БД"""
     db = SessionLocal()
@@ -0,0 +1,113 @@
+"""
+Кэш снимков списка диалогов пользователей
+Снимок обновляется при каждом запросе диалогов и переиспользуется ботом
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional, Set
+from loguru import logger
+from config import settings
+from cache import TTLCache
+
+
+class DialogSnapshot:
+    """Снимок списка диалогов пользователя"""
+
+    def __init__(self, dialogs: List[Dict]):
+        self.dialogs = dialogs
+        self.by_id = {d['id']: d for d in dialogs}
+        self.fetched_at = time.monotonic()
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+class DialogSnapshotCache:
+    """
+    Снимки диалогов по пользователям
+
+    Снимок моложе ttl_seconds отдается как есть. Более старый снимок тоже отдается
+    сразу, но в фоне запускается его обновление. После max_age_seconds снимок удаляется.
+    """
+
+    def __init__(self, ttl_seconds: Optional[float] = None, max_age_seconds: Optional[float] = None):
+        self.ttl_seconds = ttl_seconds or settings.dialog_cache_ttl_seconds
+        self._snapshots = TTLCache(
+            settings.dialog_cache_max_users,
+            max_age_seconds or settings.dialog_cache_max_age_seconds
+        )
+        self._refreshing: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def put(self, user_id: int, dialogs: List[Dict]):
+        self._snapshots.set(user_id, DialogSnapshot(dialogs))
+
+    def get_snapshot(self, user_id: int) -> Optional[DialogSnapshot]:
+        return self._snapshots.get(user_id)
+
+    def find(self, user_id: int, chat_id: int) -> Optional[Dict]:
+        """Диалог из последнего снимка без обращения к API"""
+        snapshot = self._snapshots.get(user_id)
+        return snapshot.by_id.get(chat_id) if snapshot else None
+
+    async def get(self, user_id: int, client) -> List[Dict]:
+        """
+        Диалоги пользователя из кэша
+        Если снимка нет, он загружается; если устарел - обновляется в фоне
+        """
+        snapshot = self._snapshots.get(user_id)
+        if snapshot is None:
+            # get_user_dialogs сам сохраняет снимок в кэш
+            return await client.get_user_dialogs()
+
+        if snapshot.age > self.ttl_seconds:
+            self.refresh_in_background(user_id, client)
+        return snapshot.dialogs
+
+    async def find_dialog(self, user_id: int, chat_id: int, client=None) -> Optional[Dict]:
+        """
+        Найти диалог в снимке; загрузить снимок, только если диалога в нем нет
+        Без клиента используется только кэш
+        """
+        snapshot = self._snapshots.get(user_id)
+        if snapshot is not None:
+            if client is not None and snapshot.age > self.ttl_seconds:
+                self.refresh_in_background(user_id, client)
+            dialog = snapshot.by_id.get(chat_id)
+            if dialog is not None or client is None:
+                return dialog
+        elif client is None:
+            return None
+
+        dialogs = await client.get_user_dialogs()
+        return next((d for d in dialogs if d['id'] == chat_id), None)
+
+    def refresh_in_background(self, user_id: int, client):
+        """Обновить снимок в фоне (не более одного обновления на пользователя)"""
+        if user_id in self._refreshing:
+            return
+        self._refreshing.add(user_id)
+
+        async def refresh():
+            try:
+                await client.get_user_dialogs()
+            except Exception as e:
+                logger.warning(f"Не удалось обновить диалоги пользователя {user_id}: {e}")
+            finally:
+                self._refreshing.discard(user_id)
+
+        task = asyncio.create_task(refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+_dialog_cache: Optional[DialogSnapshotCache] = None
+
+
+def get_dialog_cache() -> DialogSnapshotCache:
+    """Общий для процесса кэш диалогов"""
+    global _dialog_cache
+    if _dialog_cache is None:
+        _dialog_cache = DialogSnapshotCache()
+    return _dialog_cache
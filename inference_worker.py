@@ -0,0 +1,273 @@
+"""
+Процесс инференса локальной модели
+Модель загружается только здесь; бот и сканер отправляют задачи суммаризации
+по локальному TCP-соединению (JSON по строке на сообщение)
+
+Запуск отдельно: python inference_worker.py [порт]
+Или автоматически из приложения: INFERENCE_WORKERS=N
+"""
+import asyncio
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from config import settings
+
+# Ограничение строки протокола: тексты кусков - десятки килобайт
+_STREAM_LIMIT = 16 * 1024 * 1024
+
+
+def _parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host or settings.inference_worker_host, int(port)
+
+
+async def serve_worker(host: str, port: int):
+    """Принимать задачи суммаризации и выполнять их батчами на модели этого процесса"""
+    from local_inference import BatchingGenerator, load_local_model
+
+    threads = settings.inference_worker_threads
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+    model, tokenizer, device = load_local_model()
+    batcher = BatchingGenerator(model, tokenizer, device)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        async def process(request: Dict):
+            try:
+                text = await batcher.generate(request["text"], request["max_length"])
+                response = {"id": request["id"], "result": text}
+            except Exception as e:
+                response = {"id": request["id"], "error": str(e)}
+            async with write_lock:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(process(json.loads(line)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port, limit=_STREAM_LIMIT)
+    logger.info(f"Процесс инференса слушает {host}:{port}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async with server:
+        await stop_event.wait()
+    await batcher.close()
+    logger.info(f"Процесс инференса {host}:{port} остановлен")
+
+
+class _WorkerConnection:
+    """Одно постоянное соединение с процессом инференса; ответы сопоставляются по id"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._connect_lock = asyncio.Lock()
+        self._connected_once = False
+        self.down_until = 0.0  # До этого времени (time.monotonic()) процесс считается недоступным
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    async def _ensure_connected(self):
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+
+            # При первом подключении процесс мог еще загружать модель - ждем до таймаута;
+            # потом одна попытка, а недоступный процесс пропускается на inference_backoff_seconds
+            timeout = 0 if self._connected_once else settings.inference_connect_timeout_seconds
+            deadline = asyncio.get_running_loop().time() + timeout
+            while True:
+                try:
+                    self._reader, self._writer = await asyncio.open_connection(
+                        self.host, self.port, limit=_STREAM_LIMIT
+                    )
+                    break
+                except OSError:
+                    if asyncio.get_running_loop().time() >= deadline:
+                        self.down_until = time.monotonic() + settings.inference_backoff_seconds
+                        raise
+                    await asyncio.sleep(1)
+
+            self._connected_once = True
+            self.down_until = 0.0
+            self._read_task = asyncio.create_task(self._read_loop(self._reader))
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._pending.pop(response["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(RuntimeError(response["error"]))
+                else:
+                    future.set_result(response["result"])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # Соединение потеряно: ожидающие запросы завершаются ошибкой
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Процесс инференса {self.host}:{self.port} недоступен"))
+            self._pending.clear()
+
+    async def request(self, text: str, max_length: int) -> str:
+        await self._ensure_connected()
+        # Цикл чтения обнуляет _writer при обрыве - работаем с локальной ссылкой
+        writer = self._writer
+        if writer is None or writer.is_closing():
+            raise ConnectionError(f"Процесс инференса {self.host}:{self.port} недоступен")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            writer.write(json.dumps({"id": request_id, "text": text, "max_length": max_length}).encode() + b"\n")
+            await writer.drain()
+            return await asyncio.wait_for(future, settings.inference_timeout_seconds)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._read_task is not None:
+            self._read_task.cancel()
+            await asyncio.gather(self._read_task, return_exceptions=True)
+
+
+class InferenceClient:
+    """
+    Асинхронный клиент процессов инференса
+    Запрос уходит в наименее загруженный доступный процесс; при потере соединения - в следующий,
+    при таймауте ответа - ошибка без повтора.
+    Недоступные процессы пробуются последними; on_failure вызывается при каждой ошибке соединения
+    """
+
+    def __init__(self, addresses: str, on_failure: Optional[Callable[[], None]] = None):
+        self.connections: List[_WorkerConnection] = [
+            _WorkerConnection(*_parse_address(address.strip()))
+            for address in addresses.split(",") if address.strip()
+        ]
+        self.on_failure = on_failure
+
+    async def generate(self, text: str, max_length: int) -> str:
+        last_error: Optional[Exception] = None
+        for connection in sorted(self.connections, key=lambda c: (not c.available, c.in_flight)):
+            try:
+                return await connection.request(text, max_length)
+            except asyncio.TimeoutError:
+                # Процесс жив, но не успел: в Python 3.11 TimeoutError - подкласс OSError,
+                # повтор в других процессах только умножил бы нагрузку тем же куском
+                raise
+            except (ConnectionError, OSError) as e:
+                last_error = e
+                logger.warning(f"Процесс инференса {connection.host}:{connection.port}: {e}")
+                if self.on_failure:
+                    self.on_failure()
+        raise last_error or RuntimeError("Процессы инференса не настроены")
+
+    async def close(self):
+        await asyncio.gather(*(connection.close() for connection in self.connections))
+
+
+class InferenceWorkerPool:
+    """
+    Процессы инференса, запущенные приложением, на последовательных портах
+    Завершившийся процесс перезапускается на том же порту не чаще раза в inference_backoff_seconds
+    """
+
+    def __init__(self, count: int):
+        # Ядра делятся между процессами, чтобы они не конкурировали за потоки torch
+        self.env = dict(os.environ)
+        if not settings.inference_worker_threads:
+            self.env["INFERENCE_WORKER_THREADS"] = str(max((os.cpu_count() or 1) // count, 1))
+
+        self.processes: Dict[int, subprocess.Popen] = {}  # порт -> процесс
+        self._started_at: Dict[int, float] = {}
+        for i in range(count):
+            self._spawn(settings.inference_worker_base_port + i)
+
+    @property
+    def addresses(self) -> str:
+        return ",".join(f"{settings.inference_worker_host}:{port}" for port in self.processes)
+
+    def _spawn(self, port: int):
+        self.processes[port] = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(port)],
+            env=self.env
+        )
+        self._started_at[port] = time.monotonic()
+
+    def restart_exited(self):
+        """Перезапустить завершившиеся процессы"""
+        now = time.monotonic()
+        for port, process in list(self.processes.items()):
+            code = process.poll()
+            if code is None or now - self._started_at[port] < settings.inference_backoff_seconds:
+                continue
+            logger.warning(f"Процесс инференса на порту {port} завершился с кодом {code}, перезапуск")
+            self._spawn(port)
+
+    def terminate(self):
+        for process in self.processes.values():
+            process.terminate()
+
+
+if __name__ == "__main__":
+    logger.add(
+        settings.log_file,
+        rotation="1 day",
+        retention="7 days",
+        level=settings.log_level
+    )
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else settings.inference_worker_base_port
+    try:
+        asyncio.run(serve_worker(settings.inference_worker_host, port))
+    except KeyboardInterrupt:
+        pass
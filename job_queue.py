@@ -0,0 +1,322 @@
+"""
+Надежная очередь задач для этапов обработки: загрузка, суммаризация, доставка
+Хранилище - Redis (если задан redis_url) или таблица SQLite
+"""
+import asyncio
+import json
+import sqlite3
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+from loguru import logger
+from config import settings
+
+
+@dataclass
+class Job:
+    """Задача этапа обработки"""
+    id: int
+    stage: str
+    payload: Dict
+    attempts: int = 0
+
+
+@dataclass
+class RetryPolicy:
+    """Политика повторов: экспоненциальная задержка между попытками"""
+    max_attempts: int = 5
+    base_delay: float = 30.0
+    max_delay: float = 3600.0
+
+    def delay(self, attempt: int) -> float:
+        return min(self.base_delay * (2 ** max(attempt - 1, 0)), self.max_delay)
+
+
+class SQLiteJobQueue:
+    """
+    Очередь задач в таблице SQLite
+
+    Взятая задача блокируется на visibility_timeout секунд. Если воркер не подтвердил
+    ее за это время (процесс упал), задача снова становится доступной.
+    """
+
+    def __init__(self, path: Optional[Path] = None, visibility_timeout: Optional[float] = None):
+        self.path = str(path or settings.data_dir / "jobs.db")
+        self.visibility_timeout = visibility_timeout or settings.job_visibility_timeout_seconds
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "stage TEXT NOT NULL, "
+                "payload TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "available_at REAL NOT NULL, "
+                "locked_until REAL, "
+                "last_error TEXT, "
+                "created_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_jobs_stage_status ON jobs (stage, status, available_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _enqueue(self, stage: str, payload: Dict, delay: float) -> int:
+        now = time.time()
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (stage, payload, available_at, created_at) VALUES (?, ?, ?, ?)",
+                (stage, json.dumps(payload), now + delay, now)
+            )
+            return cursor.lastrowid
+
+    def _dequeue(self, stage: str) -> Optional[Job]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE: одну задачу не возьмут два воркера или процесса
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs WHERE stage = ? AND ("
+                "(status = 'pending' AND available_at <= ?) OR "
+                "(status = 'running' AND locked_until < ?)"
+                ") ORDER BY available_at, id LIMIT 1",
+                (stage, now, now)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            job_id, payload, attempts = row
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ? WHERE id = ?",
+                (now + self.visibility_timeout, job_id)
+            )
+            conn.execute("COMMIT")
+            return Job(id=job_id, stage=stage, payload=json.loads(payload), attempts=attempts + 1)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _ack(self, job: Job):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+    def _nack(self, job: Job, error: str, retry_delay: Optional[float]):
+        with closing(self._connect()) as conn:
+            if retry_delay is None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = ? WHERE id = ?",
+                    (error, job.id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET status = 'pending', locked_until = NULL, last_error = ?, "
+                    "available_at = ? WHERE id = ?",
+                    (error, time.time() + retry_delay, job.id)
+                )
+
+    async def enqueue(self, stage: str, payload: Dict, delay: float = 0) -> int:
+        return await asyncio.to_thread(self._enqueue, stage, payload, delay)
+
+    async def dequeue(self, stage: str) -> Optional[Job]:
+        return await asyncio.to_thread(self._dequeue, stage)
+
+    async def ack(self, job: Job):
+        await asyncio.to_thread(self._ack, job)
+
+    async def nack(self, job: Job, error: str, retry_delay: Optional[float] = None):
+        """Вернуть задачу в очередь через retry_delay секунд или (None) пометить как failed"""
+        await asyncio.to_thread(self._nack, job, error, retry_delay)
+
+
+class RedisJobQueue:
+    """
+    Очередь задач в Redis
+
+    Готовые задачи - список {prefix}:{stage}:ready, отложенные - sorted set
+    {prefix}:{stage}:delayed, взятые в работу - sorted set {prefix}:{stage}:running
+    со сроком блокировки. Данные задач - hash {prefix}:data.
+    """
+
+    # Взять задачу из ready и записать ее в running со сроком - одной операцией,
+    # чтобы при сбое процесса между шагами задача не пропала из обоих списков
+    _CLAIM_SCRIPT = """
+local job_id = redis.call('RPOP', KEYS[1])
+if job_id then
+    redis.call('ZADD', KEYS[2], ARGV[1], job_id)
+end
+return job_id
+"""
+
+    # Перенести в ready задачи с наступившим сроком; ZREM отсекает уже перенесенные другим воркером
+    _PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+for _, job_id in ipairs(due) do
+    if redis.call('ZREM', KEYS[1], job_id) == 1 then
+        redis.call('LPUSH', KEYS[2], job_id)
+    end
+end
+return #due
+"""
+
+    def __init__(self, url: Optional[str] = None, client=None, prefix: str = "jobs",
+                 visibility_timeout: Optional[float] = None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url or settings.redis_url)
+        self.redis = client
+        self.prefix = prefix
+        self.visibility_timeout = visibility_timeout or settings.job_visibility_timeout_seconds
+        self._claim = self.redis.register_script(self._CLAIM_SCRIPT)
+        self._promote_due = self.redis.register_script(self._PROMOTE_SCRIPT)
+
+    def _key(self, stage: str, name: str) -> str:
+        return f"{self.prefix}:{stage}:{name}"
+
+    async def enqueue(self, stage: str, payload: Dict, delay: float = 0) -> int:
+        job_id = await self.redis.incr(f"{self.prefix}:id")
+        data = json.dumps({"stage": stage, "payload": payload, "attempts": 0})
+        await self.redis.hset(f"{self.prefix}:data", job_id, data)
+        if delay > 0:
+            await self.redis.zadd(self._key(stage, "delayed"), {job_id: time.time() + delay})
+        else:
+            await self.redis.lpush(self._key(stage, "ready"), job_id)
+        return job_id
+
+    async def _promote(self, stage: str, source: str):
+        """Перенести в ready задачи, у которых наступил срок (отложенные или зависшие)"""
+        await self._promote_due(keys=[self._key(stage, source), self._key(stage, "ready")], args=[time.time()])
+
+    async def dequeue(self, stage: str) -> Optional[Job]:
+        await self._promote(stage, "delayed")
+        await self._promote(stage, "running")
+
+        job_id = await self._claim(
+            keys=[self._key(stage, "ready"), self._key(stage, "running")],
+            args=[time.time() + self.visibility_timeout]
+        )
+        if job_id is None:
+            return None
+
+        raw = await self.redis.hget(f"{self.prefix}:data", job_id)
+        if raw is None:
+            await self.redis.zrem(self._key(stage, "running"), job_id)
+            return None
+
+        data = json.loads(raw)
+        data["attempts"] += 1
+        await self.redis.hset(f"{self.prefix}:data", job_id, json.dumps(data))
+        return Job(id=int(job_id), stage=stage, payload=data["payload"], attempts=data["attempts"])
+
+    async def ack(self, job: Job):
+        await self.redis.zrem(self._key(job.stage, "running"), job.id)
+        await self.redis.hdel(f"{self.prefix}:data", job.id)
+
+    async def nack(self, job: Job, error: str, retry_delay: Optional[float] = None):
+        await self.redis.zrem(self._key(job.stage, "running"), job.id)
+        if retry_delay is None:
+            raw = await self.redis.hget(f"{self.prefix}:data", job.id)
+            await self.redis.hset(f"{self.prefix}:failed", job.id, json.dumps({
+                "job": json.loads(raw) if raw else None,
+                "error": error
+            }))
+            await self.redis.hdel(f"{self.prefix}:data", job.id)
+        else:
+            await self.redis.zadd(self._key(job.stage, "delayed"), {job.id: time.time() + retry_delay})
+
+
+def create_job_queue():
+    """Очередь задач: Redis, если задан redis_url, иначе SQLite"""
+    if settings.redis_url:
+        try:
+            queue = RedisJobQueue(settings.redis_url)
+            logger.info("Очередь задач: Redis")
+            return queue
+        except Exception as e:
+            logger.error(f"Ошибка подключения очереди задач к Redis: {e}, используется SQLite")
+    logger.info("Очередь задач: SQLite")
+    return SQLiteJobQueue()
+
+
+class JobPipeline:
+    """
+    Этапы обработки с отдельными пулами воркеров и политиками повторов
+
+    Обработчик этапа получает payload задачи. Исключение в обработчике
+    приводит к повтору задачи по политике этапа; после исчерпания попыток
+    задача помечается как failed.
+    """
+
+    def __init__(self, queue, poll_interval: Optional[float] = None):
+        self.queue = queue
+        self.poll_interval = poll_interval or settings.job_poll_interval_seconds
+        self._stages: Dict[str, tuple] = {}  # stage -> (handler, workers, retry)
+        self._tasks: List[asyncio.Task] = []
+
+    def register(
+        self,
+        stage: str,
+        handler: Callable[[Dict], Awaitable[None]],
+        workers: int = 1,
+        retry: Optional[RetryPolicy] = None
+    ):
+        self._stages[stage] = (handler, max(1, workers), retry or RetryPolicy())
+
+    async def enqueue(self, stage: str, payload: Dict, delay: float = 0) -> int:
+        return await self.queue.enqueue(stage, payload, delay)
+
+    async def _worker(self, stage: str):
+        handler, _, retry = self._stages[stage]
+        while True:
+            try:
+                job = await self.queue.dequeue(stage)
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди {stage}: {e}")
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            try:
+                await handler(job.payload)
+                await self.queue.ack(job)
+            except asyncio.CancelledError:
+                # Задача вернется в очередь по истечении блокировки
+                raise
+            except Exception as e:
+                if job.attempts < retry.max_attempts:
+                    delay = retry.delay(job.attempts)
+                    logger.warning(
+                        f"Задача {stage}#{job.id} завершилась ошибкой (попытка {job.attempts}), "
+                        f"повтор через {delay:.0f} с: {e}"
+                    )
+                    await self.queue.nack(job, str(e), retry_delay=delay)
+                else:
+                    logger.error(f"Задача {stage}#{job.id} отклонена после {job.attempts} попыток: {e}")
+                    await self.queue.nack(job, str(e))
+
+    def start(self):
+        """Запустить воркеры всех этапов"""
+        if self._tasks:
+            return
+        for stage, (_, workers, _) in self._stages.items():
+            for _ in range(workers):
+                self._tasks.append(asyncio.create_task(self._worker(stage)))
+            logger.info(f"Этап {stage}: запущено воркеров - {workers}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
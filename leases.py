@@ -0,0 +1,245 @@
+"""
+Распределение пользователей между процессами-сканерами через аренду в БД
+Каждый пользователь в каждый момент сканируется не более чем одним процессом
+"""
+import asyncio
+import os
+import random
+import socket
+from datetime import datetime, timedelta
+from typing import Optional, Set
+from loguru import logger
+from sqlalchemy import func, or_, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from config import settings
+from database import ScanLease, SessionLocal
+
+
+def default_worker_id() -> str:
+    """Идентификатор процесса: хост и PID"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseManager:
+    """
+    Аренда пользователей процессом-сканером
+
+    Пользователь захватывается строкой в scan_leases со сроком действия. Пока аренда
+    продлевается, другие процессы этого пользователя не берут. Если процесс умер,
+    аренда истекает и пользователя забирает другой процесс. После сканирования
+    аренда освобождается с отметкой last_completed_at, чтобы пользователя не
+    просканировали повторно в том же цикле.
+
+    Live-подписка закрепляет пользователя за процессом отдельной арендой
+    (live_worker_id): пока она действует, другие процессы его не подписывают
+    и не сканируют, чтобы один .session не открывался из нескольких процессов.
+    """
+
+    def __init__(self, worker_id: Optional[str] = None, ttl_seconds: Optional[int] = None):
+        self.worker_id = worker_id or settings.scan_worker_id or default_worker_id()
+        self.ttl_seconds = ttl_seconds or settings.scan_lease_ttl_seconds
+        self.held: Set[int] = set()
+        self.live: Set[int] = set()  # Пользователи с live-подпиской в этом процессе
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    def _expires_at(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+
+    def claim(self, user_id: int) -> bool:
+        """Попытаться арендовать пользователя; False - его сканирует другой процесс"""
+        now = datetime.utcnow()
+        rescan_before = now - timedelta(hours=settings.scan_lease_rescan_hours)
+        db = SessionLocal()
+        try:
+            result = db.execute(
+                update(ScanLease)
+                .where(
+                    ScanLease.user_id == user_id,
+                    or_(ScanLease.expires_at < now, ScanLease.worker_id == self.worker_id),
+                    or_(ScanLease.last_completed_at.is_(None), ScanLease.last_completed_at < rescan_before),
+                    or_(
+                        ScanLease.live_worker_id.is_(None),
+                        ScanLease.live_expires_at < now,
+                        ScanLease.live_worker_id == self.worker_id
+                    )
+                )
+                .values(worker_id=self.worker_id, expires_at=self._expires_at())
+            )
+            if result.rowcount == 0:
+                if db.get(ScanLease, user_id) is not None:
+                    db.rollback()
+                    return False
+                db.add(ScanLease(
+                    user_id=user_id,
+                    worker_id=self.worker_id,
+                    expires_at=self._expires_at()
+                ))
+            db.commit()
+        except (IntegrityError, OperationalError) as e:
+            # Строку одновременно создал другой процесс или БД занята - пользователь не наш
+            db.rollback()
+            logger.debug(f"Не удалось арендовать пользователя {user_id}: {e}")
+            return False
+        finally:
+            db.close()
+
+        self.held.add(user_id)
+        return True
+
+    def seconds_until_free(self, user_id: int) -> Optional[float]:
+        """
+        Через сколько секунд истекает аренда пользователя другим процессом
+        None - аренды другого процесса нет (пользователь свободен или уже просканирован)
+        """
+        db = SessionLocal()
+        try:
+            lease = db.get(ScanLease, user_id)
+        finally:
+            db.close()
+        if lease is None or lease.worker_id is None or lease.worker_id == self.worker_id:
+            return None
+        remaining = (lease.expires_at - datetime.utcnow()).total_seconds()
+        return remaining if remaining > 0 else 0.0
+
+    def claim_live(self, user_id: int) -> bool:
+        """Закрепить пользователя за процессом для live-подписки; False - он закреплен за другим"""
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            result = db.execute(
+                update(ScanLease)
+                .where(
+                    ScanLease.user_id == user_id,
+                    or_(
+                        ScanLease.live_worker_id.is_(None),
+                        ScanLease.live_expires_at < now,
+                        ScanLease.live_worker_id == self.worker_id
+                    )
+                )
+                .values(live_worker_id=self.worker_id, live_expires_at=self._expires_at())
+            )
+            if result.rowcount == 0:
+                if db.get(ScanLease, user_id) is not None:
+                    db.rollback()
+                    return False
+                db.add(ScanLease(
+                    user_id=user_id,
+                    expires_at=now,
+                    live_worker_id=self.worker_id,
+                    live_expires_at=self._expires_at()
+                ))
+            db.commit()
+        except (IntegrityError, OperationalError) as e:
+            db.rollback()
+            logger.debug(f"Не удалось закрепить пользователя {user_id} для live-режима: {e}")
+            return False
+        finally:
+            db.close()
+
+        self.live.add(user_id)
+        return True
+
+    def release_live(self, user_id: int):
+        """Снять закрепление live-подписки"""
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(ScanLease)
+                .where(ScanLease.user_id == user_id, ScanLease.live_worker_id == self.worker_id)
+                .values(live_worker_id=None, live_expires_at=datetime.utcnow())
+            )
+            db.commit()
+        finally:
+            db.close()
+            self.live.discard(user_id)
+
+    def active_count(self) -> int:
+        """Число пользователей, сканируемых сейчас всеми процессами"""
+        db = SessionLocal()
+        try:
+            return db.query(func.count(ScanLease.user_id)).filter(
+                ScanLease.worker_id.isnot(None),
+                ScanLease.expires_at > datetime.utcnow()
+            ).scalar() or 0
+        finally:
+            db.close()
+
+    async def wait_for_capacity(self, limit: int, poll_seconds: float = 5.0):
+        """
+        Дождаться, пока число сканирований по всем процессам станет меньше limit
+        Проверка не атомарна с claim, поэтому лимит может быть кратко превышен на число процессов
+        """
+        if limit <= 0:
+            return
+        while self.active_count() >= limit:
+            await asyncio.sleep(random.uniform(poll_seconds / 2, poll_seconds))
+
+    def release(self, user_id: int, completed: bool = True):
+        """Освободить пользователя; completed - сканирование завершено"""
+        db = SessionLocal()
+        try:
+            values = {"worker_id": None, "expires_at": datetime.utcnow()}
+            if completed:
+                values["last_completed_at"] = datetime.utcnow()
+            db.execute(
+                update(ScanLease)
+                .where(ScanLease.user_id == user_id, ScanLease.worker_id == self.worker_id)
+                .values(**values)
+            )
+            db.commit()
+        finally:
+            db.close()
+            self.held.discard(user_id)
+
+    def renew(self):
+        """
+        Продлить аренду всех пользователей, которых сканирует процесс, и live-закрепления
+        Закрепления, перехваченные другим процессом (после истечения), убираются из live
+        """
+        if not self.held and not self.live:
+            return
+        db = SessionLocal()
+        try:
+            if self.held:
+                db.execute(
+                    update(ScanLease)
+                    .where(ScanLease.user_id.in_(self.held), ScanLease.worker_id == self.worker_id)
+                    .values(expires_at=self._expires_at())
+                )
+            if self.live:
+                db.execute(
+                    update(ScanLease)
+                    .where(ScanLease.user_id.in_(self.live), ScanLease.live_worker_id == self.worker_id)
+                    .values(live_expires_at=self._expires_at())
+                )
+                kept = {
+                    user_id for (user_id,) in db.query(ScanLease.user_id).filter(
+                        ScanLease.user_id.in_(self.live),
+                        ScanLease.live_worker_id == self.worker_id
+                    ).all()
+                }
+                lost = self.live - kept
+                if lost:
+                    logger.warning(f"Live-закрепление пользователей {sorted(lost)} перешло к другому процессу")
+                    self.live = kept
+            db.commit()
+        finally:
+            db.close()
+
+    async def _heartbeat(self):
+        interval = max(self.ttl_seconds / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.renew()
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды ({self.worker_id}): {e}")
+
+    def start_heartbeat(self):
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    def stop_heartbeat(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
@@ -0,0 +1,192 @@
+"""
+Live-режим: получение новых сообщений через обновления Telegram
+Сообщения буферизуются в памяти и пачками записываются в БД
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+from loguru import logger
+from telethon import events, utils
+from config import settings
+from database import Channel, SessionLocal, advance_watermarks, bulk_insert_messages
+from telegram_client import SafeTelegramClient
+
+
+class LiveIngestor:
+    """
+    Подписка подключенных клиентов на новые сообщения активных каналов
+
+    Обработчик обновлений только кладет сообщение в буфер. Буфер записывается в БД
+    раз в live_flush_interval_seconds или при накоплении live_flush_batch_size сообщений,
+    вместе с записью watermark каналов.
+
+    catch_up(user_id, client) вызывается сразу после подписки и догружает сообщения,
+    пришедшие до нее: иначе первое live-сообщение сдвинет watermark через пропуск.
+    """
+
+    def __init__(
+        self,
+        client_pool,
+        catch_up: Optional[Callable[[int, SafeTelegramClient], Awaitable]] = None
+    ):
+        self.client_pool = client_pool
+        self.catch_up = catch_up
+        self._handlers: Dict[int, tuple] = {}  # user_id -> (client, handler)
+        self._channels: Dict[int, Dict[int, int]] = {}  # user_id -> {telegram_chat_id: channel_id}
+        self._buffer: List[Dict] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._pending_flush: Optional[asyncio.Task] = None  # Запись по переполнению буфера
+
+    def is_subscribed(self, user_id: int) -> bool:
+        return user_id in self._handlers
+
+    @property
+    def subscribed(self) -> List[int]:
+        return list(self._handlers)
+
+    def _load_channels(self, user_ids: List[int]):
+        """Активные каналы подписанных пользователей (один запрос)"""
+        if not user_ids:
+            return
+        db = SessionLocal()
+        try:
+            rows = db.query(Channel.user_id, Channel.telegram_chat_id, Channel.id).filter(
+                Channel.user_id.in_(user_ids),
+                Channel.is_active == True
+            ).all()
+        finally:
+            db.close()
+
+        channels = {user_id: {} for user_id in user_ids}
+        for user_id, chat_id, channel_id in rows:
+            channels[user_id][chat_id] = channel_id
+        self._channels.update(channels)
+
+    async def subscribe(self, user_id: int, phone: Optional[str]) -> bool:
+        """Подписать клиент пользователя на новые сообщения"""
+        if self.is_subscribed(user_id):
+            return True
+
+        # Клиент остается занятым, пока действует подписка, и не вытесняется из пула
+        client: Optional[SafeTelegramClient] = await self.client_pool.checkout(user_id, phone)
+        if client is None:
+            return False
+
+        self._load_channels([user_id])
+
+        async def on_new_message(event):
+            self._on_message(user_id, client, event)
+
+        client.client.add_event_handler(on_new_message, events.NewMessage(incoming=True, outgoing=True))
+        self._handlers[user_id] = (client, on_new_message)
+        logger.info(f"Live-режим включен для пользователя {user_id}")
+
+        if self.catch_up is not None:
+            # watermark читается до первой записи буфера; пересечение с live-сообщениями
+            # отсекается уникальным индексом при вставке
+            try:
+                await self.catch_up(user_id, client)
+            except Exception as e:
+                logger.error(f"Ошибка догрузки сообщений пользователя {user_id}: {e}")
+        return True
+
+    def unsubscribe(self, user_id: int):
+        """Отписать пользователя и вернуть клиент в пул"""
+        entry = self._handlers.pop(user_id, None)
+        if entry is None:
+            return
+        client, handler = entry
+        if client.client:
+            client.client.remove_event_handler(handler)
+        self._channels.pop(user_id, None)
+        self.client_pool.release(user_id)
+        logger.info(f"Live-режим выключен для пользователя {user_id}")
+
+    def _on_message(self, user_id: int, client: SafeTelegramClient, event):
+        """Положить сообщение в буфер, если чат выбран пользователем"""
+        message = event.message
+        if not message.text:
+            return
+
+        # В хранимых каналах используется id сущности без префикса (-100...)
+        chat_id, _ = utils.resolve_id(event.chat_id)
+        channel_id = self._channels.get(user_id, {}).get(chat_id)
+        if channel_id is None:
+            return
+
+        self._buffer.append({
+            'channel_id': channel_id,
+            'telegram_message_id': message.id,
+            'text': message.text,
+            'author': client.get_author(message),
+            'timestamp': message.date,
+            'message_type': 'text'
+        })
+
+        if len(self._buffer) >= settings.live_flush_batch_size:
+            # Одна задача записи на переполнение; новые сообщения дописываются ею же
+            if self._pending_flush is None or self._pending_flush.done():
+                self._pending_flush = asyncio.create_task(self._flush_while_full())
+
+    async def _flush_while_full(self):
+        """Записывать буфер, пока он переполнен (при ошибке записи - до следующего периода)"""
+        while len(self._buffer) >= settings.live_flush_batch_size:
+            if not await self.flush():
+                break
+
+    async def flush(self) -> int:
+        """Записать буфер в БД одной пачкой вместе с watermark каналов"""
+        async with self._flush_lock:
+            if not self._buffer:
+                return 0
+            rows, self._buffer = self._buffer, []
+
+            watermarks: Dict[int, int] = {}
+            for row in rows:
+                channel_id = row['channel_id']
+                watermarks[channel_id] = max(watermarks.get(channel_id, 0), row['telegram_message_id'])
+
+            db = SessionLocal()
+            try:
+                inserted = bulk_insert_messages(db, rows)
+                advance_watermarks(db, watermarks)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                # Возвращаем сообщения в буфер, чтобы записать при следующей попытке
+                self._buffer = rows + self._buffer
+                logger.error(f"Ошибка записи live-сообщений: {e}")
+                return 0
+            finally:
+                db.close()
+
+            logger.debug(f"Live-режим: записано {inserted} сообщений из {len(rows)}")
+            return inserted
+
+    async def _flush_loop(self):
+        """Периодическая запись буфера и обновление списка каналов"""
+        while True:
+            await asyncio.sleep(settings.live_flush_interval_seconds)
+            try:
+                await self.flush()
+                # Подхватываем чаты, включенные или выключенные через бота
+                self._load_channels(list(self._handlers.keys()))
+            except Exception as e:
+                logger.error(f"Ошибка live-режима: {e}")
+
+    def start(self):
+        """Запустить периодическую запись буфера; пользователи подписываются через subscribe()"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Остановить live-режим, записав оставшийся буфер"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        for user_id in list(self._handlers.keys()):
+            self.unsubscribe(user_id)
+        if self._pending_flush is not None:
+            await asyncio.gather(self._pending_flush, return_exceptions=True)
+            self._pending_flush = None
+        await self.flush()
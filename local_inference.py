@@ -0,0 +1,161 @@
+"""
+Батчинг запросов к локальной seq2seq модели
+Одновременные запросы собираются в один вызов generate
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from loguru import logger
+from config import settings
+
+
+def load_local_model(model_path: Optional[str] = None):
+    """
+    Загрузить seq2seq модель и токенизатор на лучшее доступное устройство (MPS на Mac, CUDA, CPU)
+    Возвращает (model, tokenizer, device)
+    """
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+    import torch
+
+    model_path = model_path or settings.local_model_path
+
+    # Определение устройства с приоритетом MPS для Mac
+    device = "cpu"  # По умолчанию CPU
+
+    if settings.use_mps and torch.backends.mps.is_available():
+        device = "mps"
+        device_name = "MPS (Apple Silicon)"
+    elif torch.cuda.is_available():
+        device = "cuda:0"
+        device_name = "CUDA GPU"
+    else:
+        device_name = "CPU"
+
+    logger.info(f"Использование устройства: {device_name}")
+
+    # Загрузка модели и токенизатора
+    logger.info(f"Загрузка модели {model_path}...")
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    model.to(device)
+    model.eval()
+
+    logger.info(f"Локальная модель {model_path} загружена на {device_name}")
+    return model, tokenizer, device
+
+
+class BatchingGenerator:
+    """
+    Очередь запросов суммаризации к локальной модели
+
+    Запросы копятся до batch_size штук или local_batch_wait_ms миллисекунд
+    с момента первого запроса, затем выполняются одним батчем: тексты
+    дополняются padding до общей длины, generate вызывается один раз,
+    каждый вызывающий получает свой результат. Модель работает в отдельном
+    потоке, чтобы не блокировать event loop; батчи выполняются по одному,
+    следующий собирается, пока считается текущий.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device: str,
+        batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.batch_size = max(1, batch_size or settings.batch_size)
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else settings.local_batch_wait_ms) / 1000
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-model")
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _generate_batch(self, texts: List[str], max_length: int) -> List[str]:
+        """Один вызов generate для всего батча (выполняется в потоке модели)"""
+        import torch
+
+        inputs = self.tokenizer(
+            texts,
+            max_length=1024,
+            truncation=True,
+            padding=True,
+            return_tensors="pt"
+        ).to(self.device)
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                max_length=max_length,
+                min_length=max_length // 2,
+                num_beams=settings.local_num_beams,
+                early_stopping=True,
+                do_sample=False
+            )
+
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    async def _collect(self) -> List[Tuple[str, int, asyncio.Future]]:
+        """Дождаться первого запроса и добрать батч до batch_size или таймаута"""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+
+            # В один generate попадают запросы с одинаковой длиной сводки
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[1], []).append(item)
+
+            for max_length, items in groups.items():
+                items = [item for item in items if not item[2].done()]
+                if not items:
+                    continue
+                try:
+                    results = await loop.run_in_executor(
+                        self._executor,
+                        self._generate_batch,
+                        [text for text, _, _ in items],
+                        max_length
+                    )
+                    logger.debug(f"Локальная модель: батч из {len(items)} запросов")
+                    for (_, _, future), result in zip(items, results):
+                        if not future.done():
+                            future.set_result(result)
+                except Exception as e:
+                    for _, _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
+
+    async def generate(self, text: str, max_length: int) -> str:
+        """Суммаризация одного текста (в составе ближайшего батча)"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, max_length, future))
+        return await future
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._executor.shutdown(wait=False)
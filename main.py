@@ -3,160 +3,658 @@
 Объединяет Client API для сканирования и Bot API для доставки
 """
 import asyncio
+import random
+import signal
+import sys
+from typing import Dict, List, Optional
 from loguru import logger
 from config import settings
 from telegram_client import SafeTelegramClient
-from scheduler import SafeScheduler
+from scheduler import SafeScheduler, ScheduledJob
+from scan_engine import ScanEngine
+from scan_context import ScanContext
+from client_pool import ClientPool
+from live_ingest import LiveIngestor
+from leases import LeaseManager
+from job_queue import JobPipeline, RetryPolicy, create_job_queue
 from summarizer import MessageSummarizer
 from bot import SummaryBot
-from database import User, Channel, Message, Summary, SessionLocal
-from datetime import datetime
+from database import (
+    User, Channel, Message, Summary, ScanRun, ScanCheckpoint, SessionLocal,
+    bulk_insert_messages, save_scan_checkpoint
+)
+from datetime import datetime, timedelta
 
 
 class SummaryBotApp:
     """Главное приложение бота"""
     
     def __init__(self):
-        self.telegram_clients = {}  # user_id -> SafeTelegramClient
+        self.client_pool = ClientPool()  # user_id -> SafeTelegramClient с вытеснением простаивающих
         self.summarizer = MessageSummarizer()
         self.scheduler = SafeScheduler()
+        # Без шардирования процесс один, и общий лимит сканирований - лимит движка
+        self.scan_engine = ScanEngine(global_limit=min(
+            settings.scan_global_concurrency,
+            settings.scan_fleet_max_concurrency or settings.scan_global_concurrency
+        ))
+        # При подписке пропущенные до нее сообщения догружаются по watermark
+        self.live_ingestor = LiveIngestor(self.client_pool, catch_up=self.fetch_user_chats)
+        self._live_tasks: Dict[int, asyncio.Task] = {}  # Подписки в процессе (с догрузкой)
+        # При шардировании пользователи делятся между процессами через аренду в БД
+        self.lease_manager = LeaseManager() if settings.scan_sharding_enabled else None
+        self.worker_id = self.lease_manager.worker_id if self.lease_manager else None
+        # Конвейер этапов (загрузка -> сводка -> доставка) на надежной очереди
+        self.pipeline = self._create_pipeline() if settings.job_pipeline_enabled else None
         self.bot = SummaryBot(app_instance=self)  # Передаем ссылку на приложение
     
-    async def scan_user_chats(self, user_id: int):
+    async def fetch_user_chats(
+        self,
+        user_id: int,
+        client: SafeTelegramClient,
+        run_id: Optional[int] = None
+    ) -> int:
         """
-        Сканирование чатов для конкретного пользователя
+        Загрузка новых сообщений из чатов пользователя в БД
+        Если передан run_id, прогресс по чатам сохраняется и при повторном запуске
+        уже завершенные чаты пропускаются
+        Возвращает количество полученных сообщений
         """
-        logger.info(f"Начало сканирования для пользователя {user_id}")
+        # Загружаем активные каналы пользователя одним запросом
+        context = ScanContext(user_id)
+        db = SessionLocal()
+        try:
+            active_channels = list(context.load().values())
+            
+            if not active_channels:
+                logger.info(f"Нет активных каналов для пользователя {user_id}")
+                return 0
+            
+            # Получаем ID чатов; отбор max_chats_per_scan делает scan_chats_safe
+            chat_ids = [c.telegram_chat_id for c in active_channels]
+            channel_ids = {c.telegram_chat_id: c.id for c in active_channels}
+            
+            if run_id is not None:
+                # Продолжение прерванного запуска: watermark из контрольных точек,
+                # завершенные чаты повторно не запрашиваются
+                checkpoints = db.query(ScanCheckpoint).filter(
+                    ScanCheckpoint.run_id == run_id,
+                    ScanCheckpoint.user_id == user_id,
+                    ScanCheckpoint.telegram_chat_id.isnot(None)
+                ).all()
+                done_chats = set()
+                for checkpoint in checkpoints:
+                    if checkpoint.last_message_id:
+                        context.advance(checkpoint.telegram_chat_id, checkpoint.last_message_id)
+                    if checkpoint.status == 'done':
+                        done_chats.add(checkpoint.telegram_chat_id)
+                if done_chats:
+                    logger.info(f"Пользователь {user_id}: пропуск {len(done_chats)} уже просканированных чатов")
+                    chat_ids = [chat_id for chat_id in chat_ids if chat_id not in done_chats]
+            
+            async def store_page(chat_id: int, messages):
+                """Сохранить страницу сообщений и сдвинуть watermark чата"""
+                channel_id = channel_ids.get(chat_id)
+                if not channel_id:
+                    return
+                
+                rows = [
+                    {
+                        'channel_id': channel_id,
+                        'telegram_message_id': msg.id,
+                        'text': msg.text,
+                        'author': client.get_author(msg),
+                        'timestamp': msg.date,
+                        'message_type': 'text'
+                    }
+                    for msg in messages
+                    if msg.text
+                ]
+                
+                # Вся страница - один запрос, повторно полученные сообщения пропускаются
+                max_id = max(msg.id for msg in messages)
+                bulk_insert_messages(db, rows)
+                if run_id is not None:
+                    # Контрольная точка в той же транзакции, что и сообщения
+                    save_scan_checkpoint(db, run_id, user_id, chat_id, last_message_id=max_id)
+                db.commit()
+                
+                # Watermark сдвигается только после сохранения сообщений
+                context.advance(chat_id, max_id)
+            
+            async def chat_done(chat_id: int):
+                """Отметить чат как завершенный в текущем запуске"""
+                if run_id is None:
+                    return
+                save_scan_checkpoint(
+                    db, run_id, user_id, chat_id,
+                    status='done',
+                    last_message_id=context.watermark(chat_id)
+                )
+                db.commit()
+            
+            # Сканируем чаты безопасно, каждая страница сразу сохраняется в БД
+            counts = await client.scan_chats_safe(
+                chat_ids,
+                max_chats=settings.max_chats_per_scan,
+                on_page=store_page,
+                context=context,
+                on_chat_done=chat_done
+            )
+            return sum(counts.values())
+        finally:
+            # Watermark и время сканирования всех чатов - одной транзакцией
+            try:
+                context.flush()
+            finally:
+                context.close()
+                db.close()
+    
+    def _load_pending_messages(self, db, user_id: int):
+        """
+        Сохраненные, но еще не вошедшие в сводку сообщения активных каналов пользователя
+        Возвращает (сообщения для суммаризации, id строк messages, id чатов)
         
+        Окно отсчитывается от последней сводки пользователя, а не от текущего времени:
+        сообщения, догруженные после пропущенных дней или позже срока, тоже попадают в сводку
+        """
+        last_summary = db.query(Summary.date).filter(
+            Summary.user_id == user_id
+        ).order_by(Summary.date.desc()).first()
+        since = (last_summary[0] if last_summary else datetime.utcnow()) - timedelta(
+            hours=settings.summary_lookback_hours
+        )
+        rows = db.query(Message, Channel.telegram_chat_id).join(
+            Channel, Message.channel_id == Channel.id
+        ).filter(
+            Channel.user_id == user_id,
+            Channel.is_active == True,
+            Message.processed_at.is_(None),
+            Message.timestamp >= since
+        ).order_by(Message.timestamp).all()
+        
+        messages = [
+            {
+                'chat_id': chat_id,
+                'message_id': msg.telegram_message_id,
+                'text': msg.text,
+                'author': msg.author,
+                'timestamp': msg.timestamp
+            }
+            for msg, chat_id in rows
+        ]
+        message_ids = [msg.id for msg, _ in rows]
+        chat_ids = sorted({chat_id for _, chat_id in rows})
+        return messages, message_ids, chat_ids
+    
+    async def fetch_stage(self, user_id: int, run_id: Optional[int] = None) -> bool:
+        """
+        Этап загрузки: новые сообщения пользователя попадают в БД
+        Возвращает False, если пользователя обрабатывать не нужно
+        """
         db = SessionLocal()
         try:
             user = db.query(User).filter_by(id=user_id).first()
             
             if not user:
                 logger.error(f"Пользователь {user_id} не найден")
-                return
+                return False
             
             # Проверяем, что пользователь авторизован и включен
             if not user.is_authorized:
                 logger.info(f"Пользователь {user_id} не авторизован, пропускаем")
-                return
+                return False
             
             if not user.is_enabled:
                 logger.info(f"Пользователь {user_id} выключен, пропускаем")
-                return
+                return False
             
-            # Получаем или создаем клиент
-            if user_id not in self.telegram_clients:
-                if not user.phone:
-                    logger.error(f"У пользователя {user_id} не указан телефон")
-                    return
-                
-                client = SafeTelegramClient(user_id, user.phone)
-                if not await client.connect():
-                    logger.error(f"Не удалось подключиться для пользователя {user_id}")
-                    return
-                
-                self.telegram_clients[user_id] = client
-            else:
-                client = self.telegram_clients[user_id]
-            
-            # Получаем активные каналы пользователя
-            active_channels = [
-                c for c in user.channels 
-                if c.is_active
-            ]
+            phone = user.phone
+        finally:
+            db.close()
+        
+        if self.live_ingestor.is_subscribed(user_id):
+            # Live-режим: записываем буфер, затем дозагружаем по watermark только то,
+            # что не пришло обновлениями (новые чаты, обрывы соединения)
+            await self.live_ingestor.flush()
+        
+        # Получаем клиент из пула (подключается при необходимости)
+        client = await self.client_pool.checkout(user_id, phone)
+        if client is None:
+            raise RuntimeError(f"Не удалось получить клиент для пользователя {user_id}")
+        try:
+            await self.fetch_user_chats(user_id, client, run_id=run_id)
+        finally:
+            self.client_pool.release(user_id)
+        return True
+    
+    async def summarize_stage(self, user_id: int, run_id: Optional[int] = None) -> Optional[int]:
+        """
+        Этап суммаризации: сводка по сохраненным сообщениям, еще не вошедшим в сводку
+        Возвращает id созданной сводки или None, если новых сообщений нет
+        """
+        db = SessionLocal()
+        try:
+            all_messages, message_ids, channels_included = self._load_pending_messages(db, user_id)
             
-            if not active_channels:
-                logger.info(f"Нет активных каналов для пользователя {user_id}")
-                return
+            if not all_messages:
+                logger.info(f"Нет новых сообщений для пользователя {user_id}")
+                if run_id is not None:
+                    save_scan_checkpoint(db, run_id, user_id, status='done')
+                    db.commit()
+                return None
             
-            # Получаем ID чатов для сканирования
-            chat_ids = [c.telegram_chat_id for c in active_channels[:settings.max_chats_per_scan]]
+            # Сводки чатов кэшируются по содержимому: повторно суммаризируются только изменившиеся
+            by_chat: Dict[int, List[Dict]] = {}
+            for msg in all_messages:
+                by_chat.setdefault(msg['chat_id'], []).append(msg)
+            summary_text = await self.summarizer.summarize_chats(by_chat)
+            topics = list(self.summarizer.group_by_topic(all_messages).keys())
             
-            # Сканируем чаты безопасно
-            messages_by_chat = await client.scan_chats_safe(
-                chat_ids,
-                max_chats=settings.max_chats_per_scan
+            summary = Summary(
+                user_id=user_id,
+                date=datetime.utcnow(),
+                summary_text=summary_text,
+                topics=topics,
+                channels_included=channels_included,
+                run_id=run_id
             )
+            db.add(summary)
+            db.query(Message).filter(Message.id.in_(message_ids)).update(
+                {Message.processed_at: datetime.utcnow()},
+                synchronize_session=False
+            )
+            if run_id is not None:
+                save_scan_checkpoint(db, run_id, user_id, status='done')
+            db.commit()
             
-            # Сохраняем сообщения в БД
-            all_messages = []
-            for chat_id, messages in messages_by_chat.items():
-                db_channel = db.query(Channel).filter_by(
-                    telegram_chat_id=chat_id,
-                    user_id=user_id
-                ).first()
-                
-                if not db_channel:
-                    continue
-                
-                for msg in messages:
-                    if msg.text:
-                        db_message = Message(
-                            channel_id=db_channel.id,
-                            telegram_message_id=msg.id,
-                            text=msg.text,
-                            author=getattr(msg.sender, 'first_name', None) or 'Unknown',
-                            timestamp=msg.date,
-                            message_type='text'
-                        )
-                        db.add(db_message)
-                        all_messages.append({
-                            'text': msg.text,
-                            'author': db_message.author,
-                            'timestamp': db_message.timestamp
-                        })
-                
-                db.commit()
-            
-            # Создаем сводку
-            if all_messages:
-                summary_text = await self.summarizer.summarize_messages(all_messages)
-                topics = list(self.summarizer.group_by_topic(all_messages).keys())
-                
-                summary = Summary(
-                    user_id=user_id,
-                    date=datetime.utcnow(),
-                    summary_text=summary_text,
-                    topics=topics,
-                    channels_included=[c.telegram_chat_id for c in active_channels]
-                )
-                db.add(summary)
-                db.commit()
-                
-                # Отправляем сводку через бота
-                await self.bot.send_summary(user.telegram_id, summary_text)
-                
-                logger.info(f"Сводка создана и отправлена для пользователя {user_id}")
-            else:
-                logger.info(f"Нет новых сообщений для пользователя {user_id}")
+            logger.info(f"Сводка создана для пользователя {user_id}")
+            return summary.id
         finally:
             db.close()
     
-    async def scan_all_users(self):
-        """Сканирование для всех активных пользователей"""
+    async def deliver_stage(self, summary_id: int):
+        """Этап доставки: отправка сохраненной сводки через бота (уже отправленная пропускается)"""
+        db = SessionLocal()
+        try:
+            row = db.query(Summary.summary_text, Summary.delivered_at, User.telegram_id).join(
+                User, Summary.user_id == User.id
+            ).filter(Summary.id == summary_id).first()
+        finally:
+            db.close()
+        
+        if row is None:
+            logger.error(f"Сводка {summary_id} не найдена")
+            return
+        
+        summary_text, delivered_at, telegram_id = row
+        if delivered_at is not None:
+            logger.info(f"Сводка {summary_id} уже отправлена {delivered_at}")
+            return
+        if not await self.bot.send_summary(telegram_id, summary_text):
+            raise RuntimeError(f"Не удалось отправить сводку {summary_id}")
+        
         db = SessionLocal()
         try:
-            # Сканируем только для пользователей с включенным ботом
-            users = db.query(User).filter_by(is_enabled=True, is_authorized=True).all()
+            db.query(Summary).filter_by(id=summary_id).update({Summary.delivered_at: datetime.utcnow()})
+            db.commit()
         finally:
             db.close()
+    
+    def _undelivered_summary(self, user_id: int, run_id: int) -> Optional[int]:
+        """Сводка запуска, созданная, но еще не отправленная (после сбоя между этапами)"""
+        db = SessionLocal()
+        try:
+            row = db.query(Summary.id).filter(
+                Summary.user_id == user_id,
+                Summary.run_id == run_id,
+                Summary.delivered_at.is_(None)
+            ).order_by(Summary.id.desc()).first()
+            return row[0] if row else None
+        finally:
+            db.close()
+    
+    async def scan_user_chats(self, user_id: int, run_id: Optional[int] = None):
+        """
+        Сканирование чатов для конкретного пользователя: загрузка, сводка, доставка
+        run_id - запуск ночного сканирования для сохранения прогресса
+        """
+        logger.info(f"Начало сканирования для пользователя {user_id}")
+        
+        if not await self.fetch_stage(user_id, run_id=run_id):
+            return
         
-        for user in users:
+        summary_id = await self.summarize_stage(user_id, run_id=run_id)
+        if summary_id is None and run_id is not None:
+            # Продолжение после сбоя: сводка могла быть сохранена, но не отправлена
+            summary_id = self._undelivered_summary(user_id, run_id)
+        if summary_id is None:
+            return
+        
+        # Отправляем сводку через бота
+        try:
+            await self.deliver_stage(summary_id)
+            logger.info(f"Сводка создана и отправлена для пользователя {user_id}")
+        except Exception as e:
+            logger.error(f"Ошибка доставки сводки пользователю {user_id}: {e}")
+    
+    def _create_pipeline(self) -> JobPipeline:
+        """Конвейер этапов с отдельными пулами воркеров и повторами"""
+        pipeline = JobPipeline(create_job_queue())
+        
+        async def fetch_job(payload: dict):
+            user_id = payload['user_id']
+            if self.lease_manager:
+                await self.lease_manager.wait_for_capacity(settings.scan_fleet_max_concurrency)
+                if not self.lease_manager.claim(user_id):
+                    # Пользователя держит другой процесс: повтор после истечения его аренды
+                    delay = self._lease_retry_delay(user_id)
+                    if delay is not None:
+                        await pipeline.enqueue('fetch', payload, delay=delay)
+                    return
+            completed = False
             try:
-                await self.scan_user_chats(user.id)
-                # Задержка между пользователями
-                await asyncio.sleep(5)
-            except Exception as e:
-                logger.error(f"Ошибка сканирования для пользователя {user.id}: {e}")
+                # Запуск создается после аренды; при повторе задачи прерванный запуск продолжается
+                payload = {**payload, 'run_id': payload.get('run_id') or self._start_scan_run(user_id)}
+                if await self.fetch_stage(user_id, run_id=payload['run_id']):
+                    await pipeline.enqueue('summarize', payload)
+                else:
+                    self._finish_scan_run(payload['run_id'])
+                completed = True
+            finally:
+                if self.lease_manager:
+                    self.lease_manager.release(user_id, completed=completed)
+        
+        async def summarize_job(payload: dict):
+            run_id = payload.get('run_id')
+            summary_id = await self.summarize_stage(payload['user_id'], run_id=run_id)
+            if summary_id is None and run_id is not None:
+                # Повтор после сбоя: сводка уже сохранена, но задача доставки могла не попасть в очередь
+                summary_id = self._undelivered_summary(payload['user_id'], run_id)
+            if summary_id is not None:
+                await pipeline.enqueue('deliver', {'summary_id': summary_id})
+            # Запуск завершается только после постановки доставки
+            if run_id is not None:
+                self._finish_scan_run(run_id)
+        
+        async def deliver_job(payload: dict):
+            await self.deliver_stage(payload['summary_id'])
+        
+        pipeline.register(
+            'fetch', fetch_job,
+            workers=settings.job_fetch_workers,
+            retry=RetryPolicy(settings.job_max_attempts, settings.job_retry_base_seconds)
+        )
+        pipeline.register(
+            'summarize', summarize_job,
+            workers=settings.job_summarize_workers,
+            retry=RetryPolicy(settings.job_max_attempts, settings.job_retry_base_seconds)
+        )
+        pipeline.register(
+            'deliver', deliver_job,
+            workers=settings.job_deliver_workers,
+            retry=RetryPolicy(settings.job_max_attempts, settings.job_retry_base_seconds)
+        )
+        return pipeline
+    
+    def _start_scan_run(self, user_id: int) -> int:
+        """
+        Незавершенный запуск сканирования пользователя (после сбоя) или новый
+        Продолжаются только запуски текущего цикла: оставленные открытыми раньше
+        scan_lease_rescan_hours не должны пропускать чаты следующего дня.
+        Запуск ищется по пользователю, а не по процессу: id процесса меняется при
+        перезапуске, а одновременное сканирование исключает аренда
+        """
+        resume_after = datetime.utcnow() - timedelta(hours=settings.scan_lease_rescan_hours)
+        db = SessionLocal()
+        try:
+            run = db.query(ScanRun).join(
+                ScanCheckpoint, ScanCheckpoint.run_id == ScanRun.id
+            ).filter(
+                ScanRun.status == 'running',
+                ScanRun.started_at >= resume_after,
+                ScanCheckpoint.user_id == user_id
+            ).order_by(ScanRun.id.desc()).first()
+            if run:
+                logger.info(
+                    f"Продолжение прерванного сканирования #{run.id} пользователя {user_id} "
+                    f"от {run.started_at}"
+                )
+                return run.id
+            
+            run = ScanRun(status='running', worker_id=self.worker_id)
+            db.add(run)
+            db.commit()
+            return run.id
+        finally:
+            db.close()
+    
+    def _lease_retry_delay(self, user_id: int) -> Optional[float]:
+        """
+        Задержка повтора, если пользователя держит другой процесс: после истечения
+        его аренды (процесс мог умереть) пользователь будет просканирован в этом цикле
+        """
+        remaining = self.lease_manager.seconds_until_free(user_id)
+        if remaining is None:
+            return None
+        return remaining + random.uniform(0, 60)
+    
+    async def scan_user_scheduled(self, user_id: int) -> Optional[datetime]:
+        """
+        Сканирование пользователя в его слот (задача планировщика)
+        Возвращает время повтора, если пользователя сейчас держит другой процесс
+        """
+        if self.scheduler.should_skip_scan():
+            return None
+        
+        if self.pipeline:
+            # Конвейер: задача загрузки в надежную очередь, дальше этапы идут сами
+            await self.pipeline.enqueue('fetch', {'user_id': user_id})
+            return None
+        
+        retry_delay: Optional[float] = None
+        
+        async def scan_job(user_id: int):
+            nonlocal retry_delay
+            if not self.lease_manager:
+                run_id = self._start_scan_run(user_id)
+                await self.scan_user_chats(user_id, run_id=run_id)
+                self._finish_scan_run(run_id)
+                return
+            
+            # Общий лимит одновременных сканирований по всем процессам
+            await self.lease_manager.wait_for_capacity(settings.scan_fleet_max_concurrency)
+            if not self.lease_manager.claim(user_id):
+                retry_delay = self._lease_retry_delay(user_id)
+                return
+            completed = False
+            try:
+                # Запуск создается только после аренды, чтобы проигравшие процессы его не плодили
+                run_id = self._start_scan_run(user_id)
+                await self.scan_user_chats(user_id, run_id=run_id)
+                self._finish_scan_run(run_id)
+                completed = True
+            finally:
+                self.lease_manager.release(user_id, completed=completed)
+        
+        # При ошибке запуск остается незавершенным и продолжится со следующей попытки
+        await self.scan_engine.run_one(user_id, scan_job)
+        if retry_delay is not None:
+            logger.info(f"Пользователь {user_id} занят другим процессом, повтор через {retry_delay:.0f} с")
+            return datetime.now() + timedelta(seconds=retry_delay)
+        return None
+    
+    def sync_scan_schedule(self):
+        """Привести расписание к списку включенных пользователей (одна задача на пользователя)"""
+        db = SessionLocal()
+        try:
+            users = dict(db.query(User.id, User.phone).filter_by(is_enabled=True, is_authorized=True).all())
+        finally:
+            db.close()
+        user_ids = set(users)
+        
+        if settings.live_ingest_enabled:
+            self.sync_live_subscriptions(users)
+        
+        scheduled = {key for key in self.scheduler.keys if key.startswith('scan:')}
+        wanted = {f"scan:{user_id}" for user_id in user_ids}
+        self.scheduler.unschedule(scheduled - wanted)
+        
+        def scan_entry(user_id: int) -> ScheduledJob:
+            return ScheduledJob(
+                key=f"scan:{user_id}",
+                callback=lambda: self.scan_user_scheduled(user_id),
+                next_time=lambda after: self.scheduler.next_user_scan_time(user_id, after)
+            )
+        
+        self.scheduler.schedule(
+            scan_entry(user_id) for user_id in user_ids
+            if f"scan:{user_id}" not in scheduled
+        )
+    
+    def sync_live_subscriptions(self, users: Dict[int, Optional[str]]):
+        """
+        Привести live-подписки к списку включенных пользователей {user_id: phone}
+        Подписка с догрузкой идет фоновой задачей в лимитах движка сканирования;
+        при шардировании подписываются только закрепленные за процессом пользователи
+        """
+        for user_id in self.live_ingestor.subscribed:
+            lost = self.lease_manager is not None and user_id not in self.lease_manager.live
+            if user_id in users and not lost:
                 continue
+            self.live_ingestor.unsubscribe(user_id)
+            if self.lease_manager and not lost:
+                self.lease_manager.release_live(user_id)
+        
+        for user_id, phone in users.items():
+            if self.live_ingestor.is_subscribed(user_id) or user_id in self._live_tasks:
+                continue
+            task = asyncio.create_task(self._subscribe_live(user_id, phone))
+            self._live_tasks[user_id] = task
+            task.add_done_callback(lambda _, user_id=user_id: self._live_tasks.pop(user_id, None))
+    
+    async def _subscribe_live(self, user_id: int, phone: Optional[str]):
+        """Подписать пользователя на новые сообщения с догрузкой пропущенных"""
+        try:
+            if self.lease_manager:
+                if not self.lease_manager.claim_live(user_id):
+                    return
+                await self.lease_manager.wait_for_capacity(settings.scan_fleet_max_concurrency)
+            
+            async def subscribe_job(user_id: int):
+                if not await self.live_ingestor.subscribe(user_id, phone) and self.lease_manager:
+                    self.lease_manager.release_live(user_id)
+            
+            await self.scan_engine.run_one(user_id, subscribe_job)
+        except Exception as e:
+            logger.error(f"Не удалось включить live-режим для пользователя {user_id}: {e}")
+            if self.lease_manager and not self.live_ingestor.is_subscribed(user_id):
+                self.lease_manager.release_live(user_id)
+    
+    async def stop_live_ingestion(self):
+        """Отменить незавершенные подписки, отписать пользователей и снять закрепления"""
+        tasks = list(self._live_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.live_ingestor.stop()
+        if self.lease_manager:
+            for user_id in list(self.lease_manager.live):
+                self.lease_manager.release_live(user_id)
+    
+    def _finish_scan_run(self, run_id: int):
+        """Отметить запуск сканирования завершенным"""
+        db = SessionLocal()
+        try:
+            db.query(ScanRun).filter_by(id=run_id).update({
+                ScanRun.status: 'done',
+                ScanRun.finished_at: datetime.utcnow()
+            })
+            db.commit()
+        finally:
+            db.close()
     
     async def run_scheduler(self):
         """Запуск планировщика"""
-        async def scan_callback():
-            await self.scan_all_users()
+        async def sync_callback():
+            self.sync_scan_schedule()
+        
+        # Простаивающие клиенты отключаются в фоне
+        maintenance = asyncio.create_task(self.client_pool.run_maintenance())
+        try:
+            if settings.live_ingest_enabled:
+                self.live_ingestor.start()
+            if self.lease_manager:
+                self.lease_manager.start_heartbeat()
+            
+            # Список пользователей (и live-подписки) периодически сверяется с расписанием
+            self.sync_scan_schedule()
+            self.scheduler.schedule([ScheduledJob(
+                key='sync_users',
+                callback=sync_callback,
+                next_time=lambda after: after + timedelta(minutes=settings.schedule_sync_minutes)
+            )])
+            
+            if self.pipeline:
+                self.pipeline.start()
+            await self.scheduler.run()
+        finally:
+            maintenance.cancel()
+            if self.lease_manager:
+                self.lease_manager.stop_heartbeat()
+            if self.pipeline:
+                await self.pipeline.stop()
+            await self.stop_live_ingestion()
+    
+    async def serve(self, with_bot: bool = True):
+        """
+        Единый asyncio runtime приложения
+        Бот, планировщик, воркеры сканирования и клиенты Telethon работают задачами
+        одного event loop; остановка по SIGINT/SIGTERM в обратном порядке запуска
+        """
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows: остановка через KeyboardInterrupt
+                pass
+        
+        if with_bot:
+            await self.bot.start()
+        else:
+            # Бот нужен только для отправки сводок
+            await self.bot.app.initialize()
         
-        await self.scheduler.schedule_daily_scan(scan_callback)
+        scheduler_task = asyncio.create_task(self.run_scheduler())
+        stop_task = asyncio.create_task(stop_event.wait())
+        try:
+            done, _ = await asyncio.wait({scheduler_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+            if scheduler_task in done:
+                # Планировщик завершился сам - пробрасываем его ошибку
+                scheduler_task.result()
+        finally:
+            logger.info("Остановка приложения...")
+            self.scheduler.stop()
+            stop_task.cancel()
+            scheduler_task.cancel()
+            await asyncio.gather(scheduler_task, stop_task, return_exceptions=True)
+            
+            if with_bot:
+                await self.bot.stop()
+            else:
+                await self.bot.app.shutdown()
+            await self.client_pool.close_all()
+            await self.summarizer.close()
+    
+    async def run_scan_worker(self):
+        """
+        Запуск процесса-сканера без бота и веб-сервера
+        Несколько таких процессов делят пользователей через аренду в БД
+        """
+        logger.info(f"Запуск процесса-сканера {self.worker_id or ''}")
+        await self.serve(with_bot=False)
     
     def run(self):
         """Запуск приложения"""
@@ -164,7 +662,8 @@ class SummaryBotApp:
         
         logger.info("Запуск Telegram Summary Bot...")
         
-        # Запускаем веб-сервер авторизации в отдельном потоке
+        # Веб-сервер авторизации (синхронный Flask) работает в отдельном потоке
+        # и обращается только к БД, не к клиентам Telethon
         def run_auth_server():
             try:
                 from auth_server import app
@@ -176,28 +675,8 @@ class SummaryBotApp:
         auth_server_thread.start()
         logger.info("Веб-сервер авторизации запущен на http://localhost:5000")
         
-        # Запускаем планировщик в отдельном потоке
-        def run_scheduler_thread():
-            try:
-                asyncio.run(self.run_scheduler())
-            except Exception as e:
-                logger.error(f"Ошибка планировщика: {e}")
-        
-        scheduler_thread = threading.Thread(target=run_scheduler_thread, daemon=True)
-        scheduler_thread.start()
-        
-        # Запускаем бота в основном потоке (блокирующий вызов)
-        try:
-            # bot.run() - синхронный метод, не нужно asyncio.run
-            self.bot.run()
-        except KeyboardInterrupt:
-            logger.info("Остановка приложения...")
-            self.scheduler.stop()
-            for client in self.telegram_clients.values():
-                try:
-                    asyncio.run(client.disconnect())
-                except:
-                    pass
+        # Бот, планировщик и клиенты - в одном event loop
+        asyncio.run(self.serve())
 
 
 if __name__ == "__main__":
@@ -212,6 +691,10 @@ if __name__ == "__main__":
     app = SummaryBotApp()
     
     try:
-        app.run()  # run() - синхронный метод, не нужен asyncio.run
+        if "--scan-worker" in sys.argv:
+            # Отдельный процесс-сканер: python main.py --scan-worker
+            asyncio.run(app.run_scan_worker())
+        else:
+            app.run()
     except KeyboardInterrupt:
         logger.info("Приложение остановлено")
@@ -0,0 +1,92 @@
+"""
+Асинхронный бэкенд OpenAI для суммаризации
+Общий пул HTTP-соединений, ограничение параллельных запросов и повторы при 429/5xx
+"""
+import asyncio
+import random
+from typing import Optional
+from loguru import logger
+from config import settings
+
+
+class OpenAIBackend:
+    """
+    Неблокирующий клиент OpenAI
+
+    Все запросы идут через один AsyncOpenAI с общим httpx-пулом соединений.
+    Число одновременных запросов ограничено семафором. Ответы 429 и 5xx,
+    таймауты и ошибки соединения повторяются с экспоненциальной задержкой
+    (или по заголовку Retry-After, если он есть).
+    """
+
+    def __init__(self, api_key: Optional[str] = None, max_concurrency: Optional[int] = None):
+        import httpx
+        from openai import AsyncOpenAI
+
+        concurrency = max_concurrency or settings.openai_max_concurrency
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=concurrency,
+                max_keepalive_connections=concurrency
+            ),
+            timeout=httpx.Timeout(settings.openai_timeout_seconds, connect=10.0)
+        )
+        # Повторы делаем сами, чтобы ожидание не занимало слот семафора
+        self.client = AsyncOpenAI(
+            api_key=api_key or settings.openai_api_key,
+            http_client=self.http_client,
+            max_retries=0,
+            timeout=settings.openai_timeout_seconds
+        )
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        import openai
+
+        if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code >= 500
+        return False
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        """Задержка из заголовка Retry-After (секунды), если сервер ее указал"""
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+    async def complete(self, system: str, user: str, max_tokens: int, temperature: float = 0.7) -> str:
+        """Один запрос chat completion с повторами"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                async with self.semaphore:
+                    response = await self.client.chat.completions.create(
+                        model=settings.openai_model,
+                        messages=[
+                            {"role": "system", "content": system},
+                            {"role": "user", "content": user}
+                        ],
+                        max_tokens=max_tokens,
+                        temperature=temperature
+                    )
+                return response.choices[0].message.content.strip()
+            except Exception as e:
+                if attempt >= settings.openai_max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._retry_after(e)
+                if delay is None:
+                    delay = min(settings.openai_backoff_base_seconds * (2 ** (attempt - 1)), 60.0)
+                    delay *= random.uniform(0.5, 1.5)
+                logger.warning(f"OpenAI: {type(e).__name__}, повтор {attempt} через {delay:.1f} с")
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        await self.client.close()
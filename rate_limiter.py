@@ -0,0 +1,100 @@
+"""
+Ограничение частоты запросов к Telegram по алгоритму token bucket
+Лимиты действуют на каждый аккаунт и на весь процесс
+"""
+import asyncio
+import time
+from typing import Dict, Optional
+from config import settings
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не более capacity за раз"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0  # Пауза после FLOOD_WAIT
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """
+        Попытаться взять токены
+        Возвращает 0, если токены выданы, иначе время ожидания в секундах
+        """
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0):
+        """Дождаться и взять токены"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Заблокировать корзину на указанное время (FLOOD_WAIT)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class RateLimiter:
+    """Лимитер запросов: отдельная корзина на аккаунт плюс общая корзина процесса"""
+
+    def __init__(
+        self,
+        per_account_rate: float,
+        global_rate: float,
+        burst: Optional[float] = None
+    ):
+        self.per_account_rate = per_account_rate
+        self.burst = burst or per_account_rate
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, self.burst))
+        self.account_buckets: Dict[int, TokenBucket] = {}
+
+    def _get_account_bucket(self, account_id: int) -> TokenBucket:
+        bucket = self.account_buckets.get(account_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_account_rate, self.burst)
+            self.account_buckets[account_id] = bucket
+        return bucket
+
+    async def acquire(self, account_id: int):
+        """Дождаться разрешения на один запрос от имени аккаунта"""
+        # Сначала лимит аккаунта: аккаунт на FLOOD_WAIT не занимает общие токены
+        await self._get_account_bucket(account_id).acquire()
+        await self.global_bucket.acquire()
+
+    def pause_account(self, account_id: int, seconds: float):
+        """Приостановить запросы аккаунта, остальные аккаунты продолжают работу"""
+        self._get_account_bucket(account_id).pause(seconds)
+
+
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Общий для процесса лимитер запросов"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(
+            per_account_rate=settings.max_requests_per_second,
+            global_rate=settings.global_max_requests_per_second,
+            burst=settings.rate_limit_burst
+        )
+    return _rate_limiter
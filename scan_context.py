@@ -0,0 +1,88 @@
+"""
+Контекст сканирования пользователя
+Загружает каналы одним запросом и записывает изменения одной транзакцией
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+from loguru import logger
+from database import Channel, SessionLocal, advance_watermarks
+
+
+class ScanContext:
+    """
+    Метаданные активных каналов пользователя на время одного сканирования
+
+    Каналы загружаются одним запросом и хранятся в словаре по telegram_chat_id.
+    Новые watermark и время сканирования копятся в памяти и записываются
+    в БД одной транзакцией в flush().
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.db = SessionLocal()
+        self.channels: Dict[int, Channel] = {}
+        self._watermarks: Dict[int, int] = {}
+        self._scanned_at: Dict[int, datetime] = {}
+
+    def load(self) -> Dict[int, Channel]:
+        """Загрузить все активные каналы пользователя одним запросом"""
+        rows = self.db.query(Channel).filter_by(
+            user_id=self.user_id,
+            is_active=True
+        ).all()
+        self.channels = {c.telegram_chat_id: c for c in rows}
+        return self.channels
+
+    @property
+    def active_channels(self) -> List[Channel]:
+        return list(self.channels.values())
+
+    def get(self, chat_id: int) -> Optional[Channel]:
+        return self.channels.get(chat_id)
+
+    def watermark(self, chat_id: int) -> Optional[int]:
+        """Текущий watermark чата с учетом еще не записанных изменений"""
+        if chat_id in self._watermarks:
+            return self._watermarks[chat_id]
+        channel = self.channels.get(chat_id)
+        return channel.last_message_id if channel else None
+
+    def advance(self, chat_id: int, message_id: int):
+        """Сдвинуть watermark (вызывать только после сохранения сообщений)"""
+        current = self.watermark(chat_id)
+        if not current or message_id > current:
+            self._watermarks[chat_id] = message_id
+
+    def mark_scanned(self, chat_id: int):
+        """Отметить чат как просканированный"""
+        if chat_id in self.channels:
+            self._scanned_at[chat_id] = datetime.utcnow()
+
+    def flush(self):
+        """Записать все накопленные изменения одной транзакцией"""
+        if not self._watermarks and not self._scanned_at:
+            return
+
+        try:
+            # Watermark только растет: live-режим мог сдвинуть его дальше во время сканирования
+            advance_watermarks(self.db, {
+                self.channels[chat_id].id: message_id
+                for chat_id, message_id in self._watermarks.items()
+                if chat_id in self.channels
+            })
+            for chat_id, scanned_at in self._scanned_at.items():
+                self.channels[chat_id].last_scan_time = scanned_at
+            self.db.commit()
+            logger.debug(
+                f"Контекст сканирования пользователя {self.user_id}: "
+                f"обновлено {len(set(self._watermarks) | set(self._scanned_at))} каналов"
+            )
+            self._watermarks.clear()
+            self._scanned_at.clear()
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Ошибка записи контекста сканирования пользователя {self.user_id}: {e}")
+            raise
+
+    def close(self):
+        self.db.close()
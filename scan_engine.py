@@ -0,0 +1,96 @@
+"""
+Движок параллельного сканирования пользователей
+Ограничивает общее число одновременных сканирований и число сканирований на один аккаунт
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional
+from loguru import logger
+from config import settings
+
+
+@dataclass
+class ScanProgress:
+    """Прогресс сканирований по расписанию с запуска движка"""
+    total: int = 0
+    done: int = 0
+    failed: int = 0
+    in_flight: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def __str__(self) -> str:
+        return (
+            f"{self.done + self.failed}/{self.total} "
+            f"(успешно: {self.done}, ошибок: {self.failed}, в работе: {self.in_flight}, "
+            f"{self.elapsed:.1f} c)"
+        )
+
+
+class ScanEngine:
+    """
+    Лимиты параллельных сканирований пользователей
+
+    - global_limit: максимум одновременно выполняемых сканирований
+    - per_account_limit: максимум одновременных сканирований одного аккаунта
+    - progress: счетчики выполненных и выполняемых сканирований
+    """
+
+    def __init__(
+        self,
+        global_limit: Optional[int] = None,
+        per_account_limit: Optional[int] = None,
+        on_progress: Optional[Callable[[ScanProgress], None]] = None
+    ):
+        self.global_limit = max(1, global_limit or settings.scan_global_concurrency)
+        self.per_account_limit = max(1, per_account_limit or settings.scan_per_account_concurrency)
+        self.on_progress = on_progress
+        self.progress = ScanProgress()
+        self._global_semaphore: Optional[asyncio.Semaphore] = None
+        self._account_semaphores: Dict[int, asyncio.Semaphore] = {}
+
+    def _get_account_semaphore(self, account_id: int) -> asyncio.Semaphore:
+        """Семафор конкретного аккаунта (создается лениво)"""
+        semaphore = self._account_semaphores.get(account_id)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_account_limit)
+            self._account_semaphores[account_id] = semaphore
+        return semaphore
+
+    def _report(self, progress: ScanProgress):
+        """Сообщить о прогрессе"""
+        logger.info(f"Прогресс сканирования: {progress}")
+        if self.on_progress:
+            try:
+                self.on_progress(progress)
+            except Exception as e:
+                logger.warning(f"Ошибка обработчика прогресса: {e}")
+
+    async def run_one(self, account_id: int, job: Callable[[int], Awaitable[None]]):
+        """
+        Выполнить job(account_id) с учетом лимитов (сканирование по расписанию)
+        Исключения job пробрасываются вызывающему
+        """
+        # Семафоры привязаны к event loop, поэтому создаются при первом запуске
+        if self._global_semaphore is None:
+            self._global_semaphore = asyncio.Semaphore(self.global_limit)
+
+        progress = self.progress
+        progress.total += 1
+        try:
+            async with self._global_semaphore, self._get_account_semaphore(account_id):
+                progress.in_flight += 1
+                try:
+                    await job(account_id)
+                finally:
+                    progress.in_flight -= 1
+            progress.done += 1
+        except Exception:
+            progress.failed += 1
+            raise
+        finally:
+            self._report(progress)
@@ -1,55 +1,142 @@
 """
 Планировщик безопасного сканирования с вариацией времени
+Задачи хранятся в куче по времени запуска, время следующего запуска - в БД
 """
 import asyncio
+import hashlib
+import heapq
+import itertools
 import random
-from datetime import datetime, timedelta
-from typing import Optional
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
 from loguru import logger
 from config import settings
+from database import SessionLocal, load_schedule, save_schedule
+
+
+def _to_utc(local_time: datetime) -> datetime:
+    """Локальное время -> UTC без tzinfo (как хранится в БД)"""
+    return local_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _from_utc(utc_time: datetime) -> datetime:
+    """UTC без tzinfo -> локальное время без tzinfo"""
+    return utc_time.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+
+@dataclass
+class ScheduledJob:
+    """
+    Задача планировщика
+    next_time(after) возвращает локальное время следующего запуска после after;
+    callback может вернуть локальное время повтора вместо очередного запуска
+    """
+    key: str
+    callback: Callable[[], Awaitable[Optional[datetime]]]
+    next_time: Callable[[datetime], datetime]
+    next_run_at: Optional[datetime] = None
+    version: int = 0
 
 
 class SafeScheduler:
-    """Планировщик с защитой от детекции"""
-    
+    """
+    Планировщик с защитой от детекции
+
+    Каждая задача (например, сканирование одного пользователя) - запись в куче
+    (срок по time.monotonic(), номер, ключ). Цикл спит ровно до ближайшего срока
+    или до изменения расписания, без периодического опроса. Время следующего
+    запуска записывается в БД: пропущенные за время простоя запуски выполняются
+    после старта, разнесенные на scan_catchup_spread_minutes.
+    """
+
     def __init__(self):
         self.running = False
-        self.tasks = []
-    
-    def get_next_scan_time(self) -> datetime:
+        self.tasks: Set[asyncio.Task] = set()
+        self._jobs: Dict[str, ScheduledJob] = {}
+        self._heap: List[Tuple[float, int, str, int]] = []  # (срок, номер, ключ, версия)
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get_next_scan_time(self, day: Optional[datetime] = None) -> datetime:
         """
-        Получить время следующего сканирования с вариацией
+        Получить время начала окна сканирования с вариацией
+        day - день окна (по умолчанию ближайшее еще не начавшееся окно)
+        Внутри окна каждый пользователь сканируется в свой слот (get_user_scan_time)
         """
         now = datetime.now()
-        
+
         # Базовое время сегодня
-        base_time = now.replace(
+        base_time = (day or now).replace(
             hour=settings.scan_base_hour,
             minute=settings.scan_base_minute,
             second=0,
             microsecond=0
         )
-        
+
         # Если базовое время уже прошло, планируем на завтра
-        if base_time < now:
+        if day is None and base_time < now:
             base_time += timedelta(days=1)
-        
+
         # Добавляем случайную вариацию (±N минут)
         variation_minutes = random.randint(
             -settings.scan_time_variation_minutes,
             settings.scan_time_variation_minutes
         )
-        
+
         scan_time = base_time + timedelta(minutes=variation_minutes)
-        
+
         # Добавляем случайные секунды для большей вариации
         scan_time = scan_time.replace(
             second=random.randint(0, 59)
         )
-        
-        logger.info(f"Следующее сканирование запланировано на: {scan_time}")
+
         return scan_time
-    
+
+    def user_slot_offset(self, user_id: int) -> float:
+        """
+        Постоянное смещение слота пользователя от начала окна (секунды)
+        Считается по хэшу id, поэтому пользователи равномерно распределены по окну
+        """
+        window_seconds = max(settings.scan_window_minutes, 1) * 60
+        digest = hashlib.sha256(f"scan-slot:{user_id}".encode()).digest()
+        return int.from_bytes(digest[:8], "big") % window_seconds
+
+    def get_user_scan_time(self, user_id: int, window_start: datetime) -> datetime:
+        """
+        Время сканирования пользователя в окне: личный слот плюс случайный сдвиг
+        Сдвиг меняется каждый раз, время не выходит за границы окна
+        """
+        window_seconds = max(settings.scan_window_minutes, 1) * 60
+        jitter_seconds = settings.scan_slot_jitter_minutes * 60
+        offset = self.user_slot_offset(user_id) + random.uniform(-jitter_seconds, jitter_seconds)
+        offset = min(max(offset, 0), window_seconds)
+        return window_start + timedelta(seconds=offset)
+
+    def _earliest_window_start(self, day: datetime) -> datetime:
+        """Самое раннее возможное начало окна дня day (база минус максимальная вариация)"""
+        base_time = day.replace(
+            hour=settings.scan_base_hour,
+            minute=settings.scan_base_minute,
+            second=0,
+            microsecond=0
+        )
+        return base_time - timedelta(minutes=settings.scan_time_variation_minutes)
+
+    def next_user_scan_time(self, user_id: int, after: datetime) -> datetime:
+        """
+        Слот пользователя в ближайшем окне, которое при любой вариации начнется после after
+        Окно, уже начавшееся к after, пропускается: слот того же окна, пересчитанный после
+        сканирования с новой вариацией, мог оказаться позже него - второй запуск за ночь
+        """
+        for days in (0, 1, 2):
+            day = after + timedelta(days=days)
+            if self._earliest_window_start(day) > after:
+                return self.get_user_scan_time(user_id, self.get_next_scan_time(day=day))
+        return self.get_user_scan_time(user_id, self.get_next_scan_time(day=after + timedelta(days=3)))
+
     def should_skip_scan(self) -> bool:
         """
         Определить, нужно ли пропустить сканирование (имитация человеческого поведения)
@@ -58,49 +145,131 @@ class SafeScheduler:
             logger.info("Пропуск сканирования (имитация человеческого поведения)")
             return True
         return False
-    
-    async def wait_until(self, target_time: datetime):
-        """Ожидание до указанного времени"""
-        while datetime.now() < target_time:
-            wait_seconds = (target_time - datetime.now()).total_seconds()
-            # Ждем максимум 60 секунд за раз, чтобы можно было остановить
-            wait_seconds = min(wait_seconds, 60)
-            if wait_seconds > 0:
-                await asyncio.sleep(wait_seconds)
-    
-    async def schedule_daily_scan(self, scan_callback):
+
+    @property
+    def keys(self) -> Set[str]:
+        return set(self._jobs)
+
+    def _push(self, job: ScheduledJob, delay: float):
+        """Положить задачу в кучу со сроком через delay секунд"""
+        job.version += 1
+        deadline = time.monotonic() + max(delay, 0)
+        heapq.heappush(self._heap, (deadline, next(self._counter), job.key, job.version))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def schedule(self, jobs: Iterable[ScheduledJob]):
         """
-        Планирование ежедневного сканирования с безопасными интервалами
+        Добавить задачи в расписание
+        Время запуска берется из БД; пропущенные запуски выполняются сразу
+        (с разбросом), для новых задач время считается через next_time
         """
+        jobs = [job for job in jobs if job.key not in self._jobs]
+        if not jobs:
+            return
+
+        now = datetime.now()
+        db = SessionLocal()
+        try:
+            stored = load_schedule(db, [job.key for job in jobs])
+            new_runs = {}
+            missed = 0
+            for job in jobs:
+                if job.key in stored:
+                    job.next_run_at = _from_utc(stored[job.key])
+                else:
+                    job.next_run_at = job.next_time(now)
+                    new_runs[job.key] = _to_utc(job.next_run_at)
+
+                delay = (job.next_run_at - now).total_seconds()
+                if delay < 0:
+                    # Запуск пропущен, пока процесс не работал
+                    missed += 1
+                    delay = random.uniform(0, settings.scan_catchup_spread_minutes * 60)
+
+                self._jobs[job.key] = job
+                self._push(job, delay)
+
+            save_schedule(db, new_runs)
+            db.commit()
+        finally:
+            db.close()
+
+        logger.info(f"В расписание добавлено задач: {len(jobs)}, пропущенных запусков: {missed}")
+
+    def unschedule(self, keys: Iterable[str]):
+        """Убрать задачи из расписания (записи в куче станут неактуальными)"""
+        for key in keys:
+            self._jobs.pop(key, None)
+
+    def _save_next_run(self, job: ScheduledJob, last_run_at: datetime):
+        db = SessionLocal()
+        try:
+            save_schedule(db, {job.key: _to_utc(job.next_run_at)}, last_run_at=_to_utc(last_run_at))
+            db.commit()
+        finally:
+            db.close()
+
+    async def _fire(self, job: ScheduledJob):
+        """Выполнить задачу и запланировать следующий запуск"""
+        started_at = datetime.now()
+        retry_at = None
+        try:
+            retry_at = await job.callback()
+        except Exception as e:
+            logger.error(f"Ошибка задачи {job.key}: {e}")
+
+        if self._jobs.get(job.key) is not job:
+            return
+
+        job.next_run_at = retry_at or job.next_time(datetime.now())
+        try:
+            self._save_next_run(job, started_at)
+        except Exception as e:
+            logger.error(f"Ошибка записи расписания {job.key}: {e}")
+        self._push(job, (job.next_run_at - datetime.now()).total_seconds())
+
+    async def run(self):
+        """Цикл планировщика: спит до ближайшего срока и запускает задачи"""
         self.running = True
-        
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+
+        try:
+            await self._loop_forever()
+        finally:
+            # Незавершенные задачи при остановке отменяются, их запуски будут догнаны
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _loop_forever(self):
         while self.running:
-            try:
-                # Проверяем, нужно ли пропустить сканирование
-                if self.should_skip_scan():
-                    # Планируем на следующий день
-                    next_time = self.get_next_scan_time()
-                    await self.wait_until(next_time)
-                    continue
-                
-                # Получаем время следующего сканирования
-                next_scan_time = self.get_next_scan_time()
-                
-                # Ждем до времени сканирования
-                await self.wait_until(next_scan_time)
-                
-                # Выполняем сканирование
-                if self.running:
-                    logger.info("Начало запланированного сканирования")
-                    await scan_callback()
-                    logger.info("Сканирование завершено")
-                
-            except Exception as e:
-                logger.error(f"Ошибка в планировщике: {e}")
-                # В случае ошибки ждем час перед следующей попыткой
-                await asyncio.sleep(3600)
-    
+            # Записи удаленных и перепланированных задач пропускаются
+            while self._heap:
+                _, _, key, version = self._heap[0]
+                job = self._jobs.get(key)
+                if job is not None and job.version == version:
+                    break
+                heapq.heappop(self._heap)
+
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, key, _ = heapq.heappop(self._heap)
+            task = asyncio.create_task(self._fire(self._jobs[key]))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
     def stop(self):
-        """Остановка планировщика"""
+        """Остановка планировщика (можно вызывать из другого потока)"""
         self.running = False
+        if self._loop is not None and self._wakeup is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
         logger.info("Планировщик остановлен")
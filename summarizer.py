@@ -7,19 +7,35 @@ from typing import List, Dict, Optional
 from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 from config import settings
+from summary_cache import create_summary_cache
 from database import Message as DBMessage
 import hashlib
 import json
 
 
+def summarize_simple(text: str, max_length: int) -> str:
+    """Простая суммаризация (если AI недоступна)"""
+    sentences = text.split('.')
+    # Берем первые N предложений
+    num_sentences = min(len(sentences), max_length // 20)
+    summary = '. '.join(sentences[:num_sentences])
+    if len(sentences) > num_sentences:
+        summary += "..."
+    return summary
+
+
 class MessageSummarizer:
     """Суммаризация сообщений через AI с поддержкой масштабирования"""
     
-    def __init__(self):
+    def __init__(self, cache=None):
         self.use_openai = bool(settings.openai_api_key)
         self.use_local = bool(settings.local_model_path)
-        self.cache = {} if settings.enable_caching else None
+        # Кэш сводок: память процесса, при redis_url - еще и общий Redis
+        self.cache = cache if cache is not None else create_summary_cache()
+        # Пул для простой суммаризации без AI, чтобы она не блокировала event loop
         self.executor = ThreadPoolExecutor(max_workers=settings.max_workers)
+        self.tokenizer = None  # Токенизатор локальной модели, если она загружена в этот процесс
+        self.worker_pool = None  # Процессы инференса, запущенные этим процессом
         
         if self.use_openai:
             self._init_openai()
@@ -31,54 +47,203 @@ class MessageSummarizer:
     def _init_openai(self):
         """Инициализация OpenAI"""
         try:
-            import openai
-            self.openai_client = openai.OpenAI(api_key=settings.openai_api_key)
+            from openai_backend import OpenAIBackend
+            self.openai_backend = OpenAIBackend()
             logger.info("OpenAI клиент инициализирован")
         except Exception as e:
             logger.error(f"Ошибка инициализации OpenAI: {e}")
             self.use_openai = False
     
     def _init_local_model(self):
-        """Инициализация локальной модели с поддержкой MPS на Mac"""
+        """
+        Инициализация локальной модели с поддержкой MPS на Mac
+        При INFERENCE_WORKERS / INFERENCE_WORKER_ADDRESSES модель работает в отдельных
+        процессах, а здесь остается только клиент к ним
+        """
         try:
-            from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
-            import torch
-            
-            # Определение устройства с приоритетом MPS для Mac
-            device = "cpu"  # По умолчанию CPU
-            
-            if settings.use_mps and torch.backends.mps.is_available():
-                device = "mps"
-                device_name = "MPS (Apple Silicon)"
-            elif torch.cuda.is_available():
-                device = "cuda:0"
-                device_name = "CUDA GPU"
-            else:
-                device_name = "CPU"
-            
-            logger.info(f"Использование устройства: {device_name}")
+            if settings.inference_workers > 0 or settings.inference_worker_addresses:
+                from inference_worker import InferenceClient, InferenceWorkerPool
+                if settings.inference_worker_addresses:
+                    addresses = settings.inference_worker_addresses
+                    self.local_backend = InferenceClient(addresses)
+                else:
+                    # Упавшие процессы перезапускаются при ошибке соединения с ними
+                    self.worker_pool = InferenceWorkerPool(settings.inference_workers)
+                    addresses = self.worker_pool.addresses
+                    self.local_backend = InferenceClient(addresses, on_failure=self.worker_pool.restart_exited)
+                logger.info(f"Локальная модель в процессах инференса: {addresses}")
+                return
             
-            # Загрузка модели и токенизатора
-            logger.info(f"Загрузка модели {settings.local_model_path}...")
-            self.tokenizer = AutoTokenizer.from_pretrained(settings.local_model_path)
-            self.model = AutoModelForSeq2SeqLM.from_pretrained(settings.local_model_path)
-            self.model.to(device)
-            self.model.eval()
-            self.device = device
+            from local_inference import BatchingGenerator, load_local_model
+            model, self.tokenizer, device = load_local_model()
             
-            logger.info(f"Локальная модель {settings.local_model_path} загружена на {device_name}")
-            logger.info(f"Параллельная обработка: {settings.max_workers} потоков")
+            # Одновременные запросы объединяются в батчи
+            self.local_backend = BatchingGenerator(model, self.tokenizer, device)
+            logger.info(
+                f"Батчинг: до {settings.batch_size} запросов, ожидание {settings.local_batch_wait_ms} мс"
+            )
         except Exception as e:
             logger.error(f"Ошибка загрузки локальной модели: {e}")
             self.use_local = False
     
-    def _get_cache_key(self, messages: List[Dict]) -> str:
-        """Создание ключа кэша из сообщений"""
-        messages_str = json.dumps(
-            [msg.get('text', '') for msg in messages[:50]],
-            sort_keys=True
-        )
-        return hashlib.md5(messages_str.encode()).hexdigest()
+    def _profile(self, max_length: int) -> str:
+        """Параметры суммаризации, от которых зависит результат (бэкенд, модель, длина)"""
+        if self.use_openai:
+            backend = f"openai/{settings.openai_model}"
+        elif self.use_local:
+            backend = f"local/{settings.local_model_path}"
+        else:
+            backend = "simple"
+        profile = f"{backend}:{max_length}:{settings.summary_hierarchical}:{settings.summary_chunk_tokens}"
+        return hashlib.md5(profile.encode()).hexdigest()[:8]
+    
+    def _content_digest(self, messages: List[Dict]) -> str:
+        """Дайджест всего содержимого: чат, id и полный текст каждого сообщения"""
+        digest = hashlib.sha256()
+        for msg in messages:
+            digest.update(json.dumps(
+                [msg.get('chat_id'), msg.get('message_id'), msg.get('text', '')],
+                ensure_ascii=False
+            ).encode())
+            digest.update(b"\n")
+        return digest.hexdigest()
+    
+    def _get_cache_key(self, messages: List[Dict], max_length: int = 150) -> str:
+        """
+        Ключ кэша из полного содержимого сообщений
+        Для сообщений одного чата: chat:<id>:<диапазон id сообщений>:<хэш текстов>
+        """
+        profile = self._profile(max_length)
+        content = self._content_digest(messages)
+        
+        chat_ids = {msg.get('chat_id') for msg in messages}
+        message_ids = [msg['message_id'] for msg in messages if msg.get('message_id') is not None]
+        if len(chat_ids) == 1 and None not in chat_ids and message_ids:
+            chat_id = chat_ids.pop()
+            return f"{profile}:chat:{chat_id}:{min(message_ids)}-{max(message_ids)}:{content[:32]}"
+        return f"{profile}:messages:{content[:32]}"
+    
+    def _count_tokens(self, text: str) -> int:
+        """Число токенов: токенизатором локальной модели или оценка ~4 символа на токен"""
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        return len(text) // 4 + 1
+    
+    def _chunk_texts(self, texts: List[str], chunk_tokens: int) -> List[str]:
+        """
+        Разбить сообщения на куски не больше chunk_tokens токенов
+        Сообщения не разрезаются, кроме тех, что сами длиннее куска
+        """
+        chunks = []
+        current: List[str] = []
+        current_tokens = 0
+        
+        for text in texts:
+            tokens = self._count_tokens(text)
+            if tokens > chunk_tokens:
+                # Слишком длинное сообщение режется по символам пропорционально
+                step = max(len(text) * chunk_tokens // tokens, 1)
+                parts = [text[i:i + step] for i in range(0, len(text), step)]
+            else:
+                parts = [text]
+            
+            for part in parts:
+                part_tokens = min(self._count_tokens(part), chunk_tokens)
+                if current and current_tokens + part_tokens > chunk_tokens:
+                    chunks.append("\n".join(current))
+                    current, current_tokens = [], 0
+                current.append(part)
+                current_tokens += part_tokens
+        
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+    
+    async def _summarize_text(self, text: str, max_length: int, reduce: bool = False) -> str:
+        """Суммаризация одного куска текста выбранным бэкендом"""
+        try:
+            if self.use_openai:
+                return await self._summarize_openai(text, max_length, reduce=reduce)
+            elif self.use_local:
+                return await self.local_backend.generate(text, max_length)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, summarize_simple, text, max_length)
+        except Exception as e:
+            logger.error(f"Ошибка суммаризации: {e}")
+            return self._summarize_simple(text, max_length)
+    
+    async def _summarize_texts(self, texts: List[str], max_length: int, reduce: bool = False) -> List[str]:
+        """Параллельная суммаризация кусков текста (не больше summary_concurrency вызовов сразу)"""
+        semaphore = asyncio.Semaphore(max(settings.summary_concurrency, 1))
+        
+        async def run(text: str) -> str:
+            async with semaphore:
+                return await self._summarize_text(text, max_length, reduce=reduce)
+        
+        return await asyncio.gather(*(run(text) for text in texts))
+    
+    async def combine_summaries(self, partials: List[str], max_length: int = 150, depth: int = 1) -> str:
+        """
+        Объединить частичные сводки группами до summary_reduce_fanout штук и не больше
+        summary_chunk_tokens токенов (сводки не обрезаются). С уровня summary_max_depth
+        число сводок в группе ограничено только бюджетом токенов.
+        """
+        fanout = max(settings.summary_reduce_fanout, 2)
+        while len(partials) > 1:
+            depth += 1
+            max_items = len(partials) if depth >= settings.summary_max_depth else fanout
+            groups = self._pack_groups(partials, settings.summary_chunk_tokens, max_items)
+            partials = await self._reduce_groups(groups, max_length)
+        
+        return partials[0] if partials else "Нет новых сообщений."
+    
+    def _pack_groups(self, partials: List[str], budget: int, max_items: int) -> List[str]:
+        """
+        Жадно разложить сводки по группам: не больше max_items сводок и budget токенов в группе
+        Если ни одна пара не помещается в бюджет, сводки объединяются попарно сверх него,
+        чтобы каждый уровень уменьшал их число
+        """
+        groups: List[List[str]] = []
+        current: List[str] = []
+        current_tokens = 0
+        for partial in partials:
+            tokens = self._count_tokens(partial)
+            if current and (len(current) >= max_items or current_tokens + tokens > budget):
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(partial)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        
+        if len(groups) == len(partials):
+            groups = [partials[i:i + 2] for i in range(0, len(partials), 2)]
+        return ["\n\n".join(group) for group in groups]
+    
+    async def _reduce_groups(self, groups: List[str], max_length: int) -> List[str]:
+        """Объединение групп сводок; группы, уже объединенные раньше, берутся из кэша"""
+        if self.cache is None:
+            return await self._summarize_texts(groups, max_length, reduce=True)
+        
+        profile = self._profile(max_length)
+        keys = [f"{profile}:reduce:{hashlib.sha256(group.encode()).hexdigest()[:32]}" for group in groups]
+        results = [await self.cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        
+        reduced = await self._summarize_texts([groups[i] for i in missing], max_length, reduce=True)
+        for i, result in zip(missing, reduced):
+            results[i] = result
+            await self.cache.set(keys[i], result)
+        return results
+    
+    async def _map_reduce(self, chunks: List[str], max_length: int) -> str:
+        """
+        Иерархическая суммаризация: куски суммаризируются параллельно,
+        затем частичные сводки объединяются (combine_summaries)
+        """
+        partials = await self._summarize_texts(chunks, max_length)
+        logger.debug(f"Иерархическая суммаризация: {len(chunks)} кусков")
+        return await self.combine_summaries(partials, max_length)
     
     async def summarize_messages(
         self,
@@ -87,16 +252,18 @@ class MessageSummarizer:
     ) -> str:
         """
         Суммаризация списка сообщений с кэшированием
+        Длинный ввод суммаризируется иерархически (map-reduce по кускам)
         """
         if not messages:
             return "Нет новых сообщений."
         
         # Проверка кэша
         if self.cache is not None:
-            cache_key = self._get_cache_key(messages)
-            if cache_key in self.cache:
+            cache_key = self._get_cache_key(messages, max_length)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
                 logger.debug(f"Использован кэш для ключа {cache_key[:8]}")
-                return self.cache[cache_key]
+                return cached
         
         # Объединяем тексты сообщений
         texts = []
@@ -107,47 +274,26 @@ class MessageSummarizer:
         if not texts:
             return "Нет текстовых сообщений для суммаризации."
         
-        combined_text = "\n".join(texts[:50])  # Максимум 50 сообщений
+        if settings.summary_hierarchical:
+            chunks = self._chunk_texts(texts, settings.summary_chunk_tokens)
+        else:
+            # Без иерархии: первые 50 сообщений, обрезанные под ограничения моделей
+            combined_text = "\n".join(texts[:50])
+            max_chars = 4000
+            if len(combined_text) > max_chars:
+                combined_text = combined_text[:max_chars] + "..."
+            chunks = [combined_text]
         
-        # Обрезаем если слишком длинный (ограничения моделей)
-        max_chars = 4000
-        if len(combined_text) > max_chars:
-            combined_text = combined_text[:max_chars] + "..."
+        if len(chunks) == 1:
+            result = await self._summarize_text(chunks[0], max_length)
+        else:
+            result = await self._map_reduce(chunks, max_length)
         
-        try:
-            if self.use_openai:
-                result = await self._summarize_openai(combined_text, max_length)
-            elif self.use_local:
-                result = await self._summarize_local(combined_text, max_length)
-            else:
-                result = self._summarize_simple(combined_text, max_length)
-            
-            # Сохранение в кэш
-            if self.cache is not None:
-                cache_key = self._get_cache_key(messages)
-                self.cache[cache_key] = result
-                # Очистка старого кэша (простая реализация)
-                if len(self.cache) > 1000:
-                    # Удаляем 20% старых записей
-                    keys_to_remove = list(self.cache.keys())[:200]
-                    for key in keys_to_remove:
-                        del self.cache[key]
-            
-            return result
-        except Exception as e:
-            logger.error(f"Ошибка суммаризации: {e}")
-            return self._summarize_simple(combined_text, max_length)
-    
-    def _summarize_sync(self, messages: List[Dict], max_length: int) -> str:
-        """Синхронная обертка для суммаризации"""
-        # Создаем новый event loop для синхронного выполнения
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+        # Сохранение в кэш
+        if self.cache is not None:
+            await self.cache.set(cache_key, result)
         
-        return loop.run_until_complete(self.summarize_messages(messages, max_length))
+        return result
     
     async def summarize_batch(
         self,
@@ -155,86 +301,82 @@ class MessageSummarizer:
         max_length: int = 150
     ) -> List[str]:
         """
-        Параллельная обработка батча запросов
+        Параллельная суммаризация нескольких списков сообщений (пользователей или чатов)
+        Одновременно обрабатывается не больше max_workers списков; результаты - в порядке входа
         """
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(
-                self.executor,
-                self._summarize_sync,
-                msgs,
-                max_length
-            )
-            for msgs in messages_list
-        ]
-        return await asyncio.gather(*tasks)
+        semaphore = asyncio.Semaphore(max(settings.max_workers, 1))
+        
+        async def run(messages: List[Dict]) -> str:
+            async with semaphore:
+                return await self.summarize_messages(messages, max_length)
+        
+        results = await asyncio.gather(*(run(messages) for messages in messages_list))
+        if self.cache is not None:
+            logger.debug(f"Кэш сводок: {self.cache}")
+        return results
     
-    async def _summarize_openai(self, text: str, max_length: int) -> str:
-        """Суммаризация через OpenAI"""
+    async def summarize_chats(
+        self,
+        chats: Dict[int, List[Dict]],
+        max_length: int = 150
+    ) -> str:
+        """
+        Сводка по нескольким чатам пользователя
+        Сводка каждого чата кэшируется по дайджесту его содержимого, поэтому заново
+        суммаризируются только изменившиеся чаты. Итоговая сводка кэшируется
+        по дайджесту, собранному из дайджестов чатов.
+        """
+        chat_ids = sorted(chats)
+        user_key = None
+        if self.cache is not None:
+            chat_keys = [self._get_cache_key(chats[chat_id], max_length) for chat_id in chat_ids]
+            user_digest = hashlib.sha256("\n".join(chat_keys).encode()).hexdigest()
+            user_key = f"{self._profile(max_length)}:chats:{user_digest[:32]}"
+            cached = await self.cache.get(user_key)
+            if cached is not None:
+                logger.debug(f"Использован кэш сводки {len(chat_ids)} чатов")
+                return cached
+        
+        # Каждый чат суммаризируется отдельно (параллельно), затем сводки объединяются
+        chat_summaries = await self.summarize_batch([chats[chat_id] for chat_id in chat_ids], max_length)
+        result = await self.combine_summaries(chat_summaries, max_length)
+        
+        if user_key is not None:
+            await self.cache.set(user_key, result)
+        return result
+    
+    async def _summarize_openai(self, text: str, max_length: int, reduce: bool = False) -> str:
+        """Суммаризация через OpenAI (reduce - объединение частичных сводок)"""
+        if reduce:
+            request = f"Объедини следующие частичные сводки в одну краткую сводку (максимум {max_length} слов):\n\n{text}"
+        else:
+            request = f"Создай краткую сводку следующих сообщений (максимум {max_length} слов):\n\n{text}"
         try:
-            response = self.openai_client.chat.completions.create(
-                model=settings.openai_model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Ты помощник для создания кратких сводок сообщений из Telegram. Создай краткую сводку основных тем и важных моментов."
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Создай краткую сводку следующих сообщений (максимум {max_length} слов):\n\n{text}"
-                    }
-                ],
+            return await self.openai_backend.complete(
+                system="Ты помощник для создания кратких сводок сообщений из Telegram. Создай краткую сводку основных тем и важных моментов.",
+                user=request,
                 max_tokens=max_length * 2,  # Примерно 2 токена на слово
                 temperature=0.7
             )
-            
-            summary = response.choices[0].message.content
-            return summary.strip()
-            
         except Exception as e:
             logger.error(f"Ошибка OpenAI суммаризации: {e}")
             return self._summarize_simple(text, max_length)
     
-    def _summarize_local(self, text: str, max_length: int) -> str:
-        """Суммаризация через локальную модель"""
-        try:
-            import torch
-            
-            # Токенизация входного текста
-            inputs = self.tokenizer(
-                text,
-                max_length=1024,
-                truncation=True,
-                return_tensors="pt"
-            ).to(self.device)
-            
-            # Генерация суммаризации
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    inputs["input_ids"],
-                    max_length=max_length,
-                    min_length=max_length // 2,
-                    num_beams=4,
-                    early_stopping=True,
-                    do_sample=False
-                )
-            
-            # Декодирование результата
-            summary = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            return summary
-        except Exception as e:
-            logger.error(f"Ошибка локальной суммаризации: {e}")
-            return self._summarize_simple(text, max_length)
-    
     def _summarize_simple(self, text: str, max_length: int) -> str:
         """Простая суммаризация (если AI недоступна)"""
-        sentences = text.split('.')
-        # Берем первые N предложений
-        num_sentences = min(len(sentences), max_length // 20)
-        summary = '. '.join(sentences[:num_sentences])
-        if len(sentences) > num_sentences:
-            summary += "..."
-        return summary
+        return summarize_simple(text, max_length)
+    
+    async def close(self):
+        """Закрыть соединения бэкендов"""
+        if self.cache is not None:
+            await self.cache.close()
+        if self.use_openai:
+            await self.openai_backend.close()
+        elif self.use_local:
+            await self.local_backend.close()
+        if self.worker_pool is not None:
+            self.worker_pool.terminate()
+        self.executor.shutdown(wait=False, cancel_futures=True)
     
     def group_by_topic(self, messages: List[Dict]) -> Dict[str, List[Dict]]:
         """
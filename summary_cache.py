@@ -0,0 +1,138 @@
+"""
+Кэш сводок: L1 в памяти процесса и общий L2 в Redis
+Сводки из Redis доступны всем процессам и переживают перезапуск
+"""
+import zlib
+from typing import Optional
+from loguru import logger
+from config import settings
+from cache import CacheStats, TTLCache
+
+
+class MemoryCacheBackend:
+    """Кэш сводок в памяти процесса (LRU с TTL и ограничением объема)"""
+
+    def __init__(self, cache: Optional[TTLCache] = None):
+        self.cache = cache or TTLCache(
+            max_entries=settings.summary_cache_max_entries,
+            ttl_seconds=settings.cache_ttl_seconds,
+            max_bytes=settings.summary_cache_max_bytes
+        )
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.cache.stats
+
+    async def get(self, key: str) -> Optional[str]:
+        return self.cache.get(key)
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float] = None):
+        self.cache.set(key, value, ttl_seconds)
+
+    async def close(self):
+        pass
+
+    def __str__(self) -> str:
+        return f"память: {len(self.cache)} записей, {self.cache.total_bytes} байт; {self.cache.stats}"
+
+
+class RedisCacheBackend:
+    """
+    Кэш сводок в Redis: значения сжаты zlib, время жизни - TTL ключа
+    Ошибки Redis считаются промахом - суммаризация не должна от них зависеть
+    """
+
+    def __init__(self, url: Optional[str] = None, client=None, prefix: str = "summary"):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url or settings.redis_url)
+        self.redis = client
+        self.prefix = prefix
+        self.stats = CacheStats()
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            raw = await self.redis.get(self._key(key))
+        except Exception as e:
+            logger.warning(f"Ошибка чтения кэша сводок из Redis: {e}")
+            raw = None
+
+        if raw is None:
+            self.stats.misses += 1
+            return None
+
+        try:
+            value = zlib.decompress(raw).decode("utf-8")
+        except (zlib.error, UnicodeDecodeError) as e:
+            # Поврежденное или чужое значение - промах, сводка будет пересчитана и перезаписана
+            logger.warning(f"Поврежденное значение кэша сводок {key[:16]}: {e}")
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return value
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float] = None):
+        ttl = int(ttl_seconds if ttl_seconds is not None else settings.cache_ttl_seconds)
+        try:
+            await self.redis.set(self._key(key), zlib.compress(value.encode("utf-8")), ex=max(ttl, 1))
+        except Exception as e:
+            logger.warning(f"Ошибка записи кэша сводок в Redis: {e}")
+
+    async def close(self):
+        await self.redis.close()
+
+    def __str__(self) -> str:
+        return f"Redis: {self.stats}"
+
+
+class TieredCache:
+    """Двухуровневый кэш: сначала L1 в памяти, затем общий L2; найденное в L2 копируется в L1"""
+
+    def __init__(self, l1: MemoryCacheBackend, l2):
+        self.l1 = l1
+        self.l2 = l2
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.l1.get(key)
+        if value is not None:
+            return value
+
+        value = await self.l2.get(key)
+        if value is not None:
+            await self.l1.set(key, value)
+        return value
+
+    async def set(self, key: str, value: str, ttl_seconds: Optional[float] = None):
+        await self.l1.set(key, value, ttl_seconds)
+        await self.l2.set(key, value, ttl_seconds)
+
+    async def close(self):
+        await self.l2.close()
+
+    def __str__(self) -> str:
+        return f"{self.l1}; {self.l2}"
+
+
+def create_summary_cache(redis_client=None):
+    """
+    Кэш сводок по настройкам: None при выключенном кэшировании,
+    память + Redis при заданном redis_url (или переданном клиенте), иначе только память
+    """
+    if not settings.enable_caching:
+        return None
+
+    memory = MemoryCacheBackend()
+    if redis_client is None and not settings.redis_url:
+        logger.info("Кэш сводок: память процесса")
+        return memory
+
+    try:
+        shared = RedisCacheBackend(client=redis_client)
+        logger.info("Кэш сводок: память процесса + Redis")
+        return TieredCache(memory, shared)
+    except Exception as e:
+        logger.error(f"Ошибка подключения кэша сводок к Redis: {e}, используется память")
+        return memory
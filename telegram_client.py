@@ -4,13 +4,16 @@
 """
 import asyncio
 import random
-from datetime import datetime, timedelta
-from typing import List, Optional, Dict
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Dict
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from telethon.tl.types import User, Chat, Channel, Message as TgMessage
 from loguru import logger
 from config import settings
-from database import Channel as DBChannel, Message as DBMessage, get_db
+from rate_limiter import get_rate_limiter
+from scan_context import ScanContext
+from cache import TTLCache
+from dialog_cache import get_dialog_cache
 
 
 class SafeTelegramClient:
@@ -21,6 +24,12 @@ class SafeTelegramClient:
         self.phone = phone
         self.client: Optional[TelegramClient] = None
         self.session_file = settings.session_dir / f"user_{user_id}.session"
+        self.rate_limiter = get_rate_limiter()
+        # Имена авторов по sender_id, заполняется из сущностей, пришедших вместе с сообщениями
+        self.sender_cache = TTLCache(
+            settings.sender_cache_size,
+            settings.sender_cache_ttl_seconds
+        )
         
     async def connect(self, phone: str = None) -> bool:
         """Подключение к Telegram"""
@@ -60,19 +69,47 @@ class SafeTelegramClient:
             logger.error(f"Ошибка подключения: {e}")
             return False
     
+    async def is_healthy(self) -> bool:
+        """Проверка, что соединение с Telegram активно"""
+        try:
+            return self.client is not None and self.client.is_connected()
+        except Exception:
+            return False
+    
     async def disconnect(self):
         """Отключение от Telegram"""
         if self.client:
             await self.client.disconnect()
             logger.info(f"Отключение для пользователя {self.user_id}")
     
+    async def _call(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Выполнить запрос к Telegram с учетом лимита запросов и FLOOD_WAIT
+        После FLOOD_WAIT запросы этого аккаунта ставятся на паузу, затем запрос повторяется
+        """
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire(self.user_id)
+            try:
+                return await func(*args, **kwargs)
+            except FloodWaitError as e:
+                attempt += 1
+                wait_time = e.seconds + 1  # +1 для запаса
+                if attempt > settings.flood_wait_max_retries or wait_time > settings.flood_wait_max_seconds:
+                    raise
+                logger.warning(
+                    f"FLOOD_WAIT для пользователя {self.user_id}: ожидание {wait_time} секунд "
+                    f"(попытка {attempt}/{settings.flood_wait_max_retries})"
+                )
+                self.rate_limiter.pause_account(self.user_id, wait_time)
+    
     async def get_user_dialogs(self) -> List[Dict]:
         """Получить список диалогов пользователя"""
         if not self.client:
             raise RuntimeError("Клиент не подключен")
         
         try:
-            dialogs = await self.client.get_dialogs()
+            dialogs = await self._call(self.client.get_dialogs)
             result = []
             
             for dialog in dialogs:
@@ -82,11 +119,14 @@ class SafeTelegramClient:
                     'title': getattr(entity, 'title', None) or getattr(entity, 'first_name', 'Unknown'),
                     'type': self._get_chat_type(entity),
                     'unread_count': dialog.unread_count,
-                    'last_message_date': dialog.date
+                    'last_message_date': dialog.date,
+                    'top_message_id': dialog.message.id if dialog.message else None
                 }
                 result.append(chat_info)
             
             logger.info(f"Получено {len(result)} диалогов для пользователя {self.user_id}")
+            # Снимок переиспользуется ботом (/chats, кнопки) без повторной загрузки
+            get_dialog_cache().put(self.user_id, result)
             return result
             
         except Exception as e:
@@ -105,14 +145,31 @@ class SafeTelegramClient:
             return 'channel'
         return 'unknown'
     
+    async def _fetch_page(
+        self,
+        chat_id: int,
+        limit: int,
+        min_id: Optional[int] = None
+    ) -> List[TgMessage]:
+        """Одна страница сообщений через iter_messages (один запрос к API)"""
+        if min_id:
+            # reverse=True: от watermark вперед, чтобы при лимите не терять середину
+            iterator = self.client.iter_messages(chat_id, limit=limit, min_id=min_id, reverse=True)
+        else:
+            # Первое сканирование: только последние сообщения
+            iterator = self.client.iter_messages(chat_id, limit=limit)
+        return [msg async for msg in iterator]
+    
     async def get_messages_safe(
         self,
         chat_id: int,
-        limit: int = 100,
-        offset_date: Optional[datetime] = None
+        limit: Optional[int] = None,
+        min_id: Optional[int] = None
     ) -> List[TgMessage]:
         """
-        Безопасное получение сообщений с задержками и обработкой ошибок
+        Безопасное получение сообщений с задержками и повтором при FLOOD_WAIT
+        Если указан min_id, возвращаются только сообщения новее него (от старых к новым)
+        Ошибки пробрасываются: пустой список означает только отсутствие новых сообщений
         """
         if not self.client:
             raise RuntimeError("Клиент не подключен")
@@ -125,110 +182,220 @@ class SafeTelegramClient:
             )
             await asyncio.sleep(delay)
             
-            # Получение сообщений
-            messages = await self.client.get_messages(
+            # Получение сообщений (FLOOD_WAIT обрабатывается с повтором запроса)
+            messages = await self._call(
+                self._fetch_page,
                 chat_id,
-                limit=limit,
-                offset_date=offset_date
+                limit or settings.scan_page_size,
+                min_id
             )
             
             logger.debug(f"Получено {len(messages)} сообщений из чата {chat_id}")
             return messages
             
+        except FloodWaitError as e:
+            logger.error(f"FLOOD_WAIT {e.seconds} с для чата {chat_id}, повторы исчерпаны")
+            raise
         except Exception as e:
             logger.error(f"Ошибка получения сообщений из чата {chat_id}: {e}")
-            # Обработка FLOOD_WAIT
-            if "FLOOD_WAIT" in str(e):
-                wait_time = self._extract_flood_wait_time(str(e))
-                logger.warning(f"FLOOD_WAIT: ожидание {wait_time} секунд")
-                await asyncio.sleep(wait_time)
-            return []
+            raise
     
-    def _extract_flood_wait_time(self, error_msg: str) -> int:
-        """Извлечь время ожидания из FLOOD_WAIT ошибки"""
-        try:
-            # Формат: FLOOD_WAIT_X где X - секунды
-            import re
-            match = re.search(r'FLOOD_WAIT_(\d+)', error_msg)
-            if match:
-                return int(match.group(1)) + 1  # +1 для запаса
-        except:
-            pass
-        return 60  # По умолчанию 60 секунд
+    async def iter_message_pages(
+        self,
+        chat_id: int,
+        min_id: Optional[int] = None,
+        page_size: Optional[int] = None,
+        budget: Optional[int] = None
+    ) -> AsyncIterator[List[TgMessage]]:
+        """
+        Постраничное получение сообщений новее min_id (страницы от старых к новым)
+        В памяти одновременно находится только одна страница, общий объем ограничен budget
+        """
+        page_size = page_size or settings.scan_page_size
+        remaining = budget or settings.scan_message_budget_per_chat
+        cursor = min_id
+        
+        while remaining > 0:
+            limit = min(page_size, remaining)
+            page = await self.get_messages_safe(chat_id, limit=limit, min_id=cursor)
+            if not page:
+                return
+            
+            page = sorted(page, key=lambda msg: msg.id)
+            self._remember_senders(page)
+            yield page
+            
+            remaining -= len(page)
+            # Без watermark берем только последние сообщения, историю не догоняем
+            if not cursor or len(page) < limit:
+                return
+            cursor = page[-1].id
+        
+        logger.info(f"Чат {chat_id}: достигнут лимит {settings.scan_message_budget_per_chat} сообщений за сканирование")
+    
+    @staticmethod
+    def _display_name(entity) -> Optional[str]:
+        """Имя пользователя или название чата/канала"""
+        if entity is None:
+            return None
+        return getattr(entity, 'first_name', None) or getattr(entity, 'title', None)
+    
+    def _remember_senders(self, messages: List[TgMessage]):
+        """Запомнить авторов из сущностей, которые Telegram вернул вместе со страницей"""
+        for msg in messages:
+            # msg.sender заполняется из ответа на запрос и не требует обращений к API
+            name = self._display_name(getattr(msg, 'sender', None))
+            if msg.sender_id and name:
+                self.sender_cache.set(msg.sender_id, name)
+    
+    def get_author(self, msg: TgMessage) -> str:
+        """
+        Имя автора сообщения без дополнительных запросов к API
+        (get_sender/get_entity здесь не вызываются)
+        """
+        if msg.sender_id:
+            name = self.sender_cache.get(msg.sender_id)
+            if name:
+                return name
+        
+        name = self._display_name(getattr(msg, 'sender', None)) or getattr(msg, 'post_author', None)
+        if name and msg.sender_id:
+            self.sender_cache.set(msg.sender_id, name)
+        return name or 'Unknown'
+    
+    async def select_chats(
+        self,
+        chat_ids: List[int],
+        max_chats: Optional[int],
+        context: ScanContext
+    ) -> List[int]:
+        """
+        Отбор чатов для сканирования по одному запросу списка диалогов:
+        - чаты без сообщений новее watermark пропускаются
+        - остальные упорядочиваются по приоритету канала и числу непрочитанных
+        - из них берутся первые max_chats, порядок обработки перемешивается
+        """
+        dialogs = await self.get_user_dialogs()
+        if not dialogs:
+            # Список диалогов недоступен: прежнее поведение
+            selected = list(chat_ids[:max_chats] if max_chats else chat_ids)
+            random.shuffle(selected)
+            return selected
+        
+        dialogs_by_id = {d['id']: d for d in dialogs}
+        candidates = []
+        skipped = 0
+        
+        for chat_id in chat_ids:
+            dialog = dialogs_by_id.get(chat_id)
+            watermark = context.watermark(chat_id)
+            top_message_id = dialog.get('top_message_id') if dialog else None
+            
+            if watermark and top_message_id and top_message_id <= watermark:
+                skipped += 1
+                continue
+            
+            channel = context.get(chat_id)
+            priority = (channel.priority if channel else None) or 3
+            unread = (dialog.get('unread_count') if dialog else 0) or 0
+            # Случайное значение последним ключом - равные чаты не идут всегда в одном порядке
+            candidates.append((priority, -unread, random.random(), chat_id))
+        
+        candidates.sort()
+        selected = [c[-1] for c in candidates]
+        if max_chats:
+            selected = selected[:max_chats]
+        
+        # Случайный порядок обработки выбранных чатов
+        random.shuffle(selected)
+        
+        logger.info(
+            f"Отбор чатов для пользователя {self.user_id}: выбрано {len(selected)}, "
+            f"без новых сообщений {skipped}, отложено {len(candidates) - len(selected)}"
+        )
+        return selected
     
     async def scan_chats_safe(
         self,
         chat_ids: List[int],
-        max_chats: Optional[int] = None
-    ) -> Dict[int, List[TgMessage]]:
+        max_chats: Optional[int] = None,
+        on_page: Optional[Callable[[int, List[TgMessage]], Awaitable[None]]] = None,
+        context: Optional[ScanContext] = None,
+        on_chat_done: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> Dict[int, Any]:
         """
         Безопасное сканирование чатов с учетом всех рекомендаций:
-        - Ограничение количества
+        - Ограничение количества (приоритетные чаты с новой активностью - первыми)
         - Случайный порядок
         - Задержки между запросами
         - Инкрементальное обновление
+        
+        Если передан on_page, каждая страница сообщений сразу отдается в on_page(chat_id, page),
+        а в результате возвращается количество сообщений по чатам.
+        Иначе возвращаются сами сообщения по чатам.
+        
+        Watermark берется из context (ScanContext); если он не передан,
+        создается собственный контекст и записывается в конце сканирования.
+        После полного прохода по чату вызывается on_chat_done(chat_id); чат, сообщения
+        которого получить не удалось, не отмечается ни завершенным, ни просканированным.
         """
         if not self.client:
             raise RuntimeError("Клиент не подключен")
         
-        # Ограничение количества чатов
-        if max_chats:
-            chat_ids = chat_ids[:max_chats]
-        
-        # Случайный порядок обработки
-        random.shuffle(chat_ids)
-        
         results = {}
-        request_count = 0
         
-        for i, chat_id in enumerate(chat_ids):
-            try:
-                # Получаем время последнего сканирования из БД
-                from database import SessionLocal
-                db = SessionLocal()
+        # Метаданные каналов загружаются одним запросом, если контекст не передан
+        own_context = context is None
+        if own_context:
+            context = ScanContext(self.user_id)
+            context.load()
+        
+        try:
+            # Отбор чатов с новой активностью с учетом приоритета и лимита
+            chat_ids = await self.select_chats(chat_ids, max_chats, context)
+            
+            for i, chat_id in enumerate(chat_ids):
                 try:
-                    db_channel = db.query(DBChannel).filter_by(
-                        telegram_chat_id=chat_id,
-                        user_id=self.user_id
-                    ).first()
-                    
-                    offset_date = None
-                    if db_channel and db_channel.last_scan_time:
-                        offset_date = db_channel.last_scan_time
-                    
-                    # Получаем только новые сообщения
-                    messages = await self.get_messages_safe(
-                        chat_id,
-                        limit=100,
-                        offset_date=offset_date
-                    )
+                    await self._scan_chat(chat_id, context, on_page, results)
+                    if on_chat_done:
+                        await on_chat_done(chat_id)
                     
-                    if messages:
-                        results[chat_id] = messages
+                    # Частота запросов контролируется лимитером в self._call
                     
-                    # Обновляем время последнего сканирования
-                    if db_channel:
-                        db_channel.last_scan_time = datetime.utcnow()
-                        db.commit()
+                    # Дополнительная задержка между чатами
+                    if i < len(chat_ids) - 1:  # Не для последнего
+                        delay = random.uniform(0.5, 2.0)
+                        await asyncio.sleep(delay)
+                        
+                except Exception as e:
+                    logger.error(f"Ошибка сканирования чата {chat_id}: {e}")
+                    continue
+        finally:
+            if own_context:
+                try:
+                    context.flush()
                 finally:
-                    db.close()
-                
-                request_count += 1
-                
-                # Контроль частоты запросов
-                if request_count >= settings.max_requests_per_second:
-                    logger.info("Достигнут лимит запросов, пауза 1 секунда")
-                    await asyncio.sleep(1)
-                    request_count = 0
-                
-                # Дополнительная задержка между чатами
-                if i < len(chat_ids) - 1:  # Не для последнего
-                    delay = random.uniform(0.5, 2.0)
-                    await asyncio.sleep(delay)
-                    
-            except Exception as e:
-                logger.error(f"Ошибка сканирования чата {chat_id}: {e}")
-                continue
+                    context.close()
         
         logger.info(f"Сканирование завершено: {len(results)} чатов обработано")
         return results
+    
+    async def _scan_chat(
+        self,
+        chat_id: int,
+        context: ScanContext,
+        on_page: Optional[Callable[[int, List[TgMessage]], Awaitable[None]]],
+        results: Dict[int, Any]
+    ):
+        """Сканирование одного чата начиная с watermark из контекста"""
+        # Получаем только сообщения новее watermark, постранично
+        # Сам watermark сдвигается после сохранения сообщений в БД
+        async for page in self.iter_message_pages(chat_id, min_id=context.watermark(chat_id)):
+            if on_page:
+                await on_page(chat_id, page)
+                results[chat_id] = results.get(chat_id, 0) + len(page)
+            else:
+                results.setdefault(chat_id, []).extend(page)
+        
+        # Время последнего сканирования записывается вместе с остальными изменениями контекста
+        context.mark_scanned(chat_id)
@@ -0,0 +1,12 @@
+"""
+Общая настройка тестов: обязательные параметры Telegram для импорта config
+"""
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("TELEGRAM_API_ID", "1")
+os.environ.setdefault("TELEGRAM_API_HASH", "test")
+os.environ.setdefault("BOT_TOKEN", "test")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,72 @@
+"""
+Тесты двухуровневого кэша сводок (память процесса + Redis)
+"""
+import asyncio
+import zlib
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from summary_cache import MemoryCacheBackend, RedisCacheBackend, TieredCache
+
+
+def _tiered(redis) -> TieredCache:
+    return TieredCache(MemoryCacheBackend(), RedisCacheBackend(client=redis))
+
+
+def test_l2_hit_populates_l1():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis()
+        await RedisCacheBackend(client=redis).set("key", "сводка")
+
+        cache = _tiered(redis)
+        assert await cache.get("key") == "сводка"
+        assert cache.l2.stats.hits == 1
+        # Повторное чтение - из памяти, без обращения к Redis
+        assert await cache.get("key") == "сводка"
+        assert cache.l1.stats.hits == 1
+        assert cache.l2.stats.hits == 1
+
+    asyncio.run(scenario())
+
+
+def test_caches_share_redis():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis()
+        first, second = _tiered(redis), _tiered(redis)
+
+        await first.set("key", "сводка")
+        assert await second.get("key") == "сводка"
+        assert await second.get("missing") is None
+
+    asyncio.run(scenario())
+
+
+def test_values_are_compressed():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis()
+        await _tiered(redis).set("key", "сводка " * 100)
+
+        raw = await redis.get("summary:key")
+        assert len(raw) < len(("сводка " * 100).encode("utf-8"))
+        assert zlib.decompress(raw).decode("utf-8") == "сводка " * 100
+
+    asyncio.run(scenario())
+
+
+def test_corrupt_value_is_miss():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis()
+        await redis.set("summary:key", b"not zlib")
+
+        cache = _tiered(redis)
+        assert await cache.get("key") is None
+        assert cache.l2.stats.misses == 1
+        assert cache.l2.stats.hits == 0
+
+        # После пересчета значение перезаписывается и читается нормально
+        await cache.set("key", "сводка")
+        assert await _tiered(redis).get("key") == "сводка"
+
+    asyncio.run(scenario())